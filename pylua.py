@@ -3,10 +3,20 @@ import sys
 import os
 import ast
 import re
+import copy
+import numbers
+import inspect
+import logging
+import textwrap
+import functools
 import subprocess
 
 lua_exe = '~/src/luajit-2.0/src/luajit'
 lua_exe = os.path.normpath(os.path.expanduser(lua_exe))
+# Lua module with the PYLUA runtime, require()d into the @jit Lua state
+lua_runtime = 'pylua'
+
+log = logging.getLogger(__name__)
 
 # a modified version of the function from ast.py, with an optional "whitespace"
 # argument
@@ -43,8 +53,19 @@ def dump(node, annotate_fields=True, include_attributes=False, whitespace=False)
     return _format(node)
 
 class PyLua(ast.NodeVisitor):
-    def __init__(self):
+    def __init__(self, lua_version=(5, 1), extern=None):
         self.stream = io.StringIO()
+        # target Lua version; (5, 1) covers LuaJIT 2.0
+        self.lua_version = lua_version
+        # names of this module's functions which other modules use; None when
+        # unknown, i.e. when not translating the whole program
+        self.extern = None if extern is None else set(extern)
+        # function name -> number of values, for functions returning Lua multiple values
+        self.multireturn = {}
+        # ... and the id()s of their FunctionDefs
+        self.multireturn_defs = set()
+        # the functions being translated, innermost last
+        self.functions = []
         self.indentation = 0
         # variable name scopes (environments); FIXME: leaky heuristic
         self.envs = [{}]
@@ -52,6 +73,18 @@ class PyLua(ast.NodeVisitor):
         self.wantcontinue = set()
         # packages, and other stuff which doesn't require ':' calling convention
         self.nocolon = set()
+        # constant literals used in 'in' tests -> name of their module-level lookup table
+        self.consttables = {}
+        # id() of loop-invariant nodes -> name of the local they were hoisted into
+        self.loopsubst = {}
+        # library functions used inside the outermost loop: local name -> function
+        self.loopstd = None
+        # counter for fresh local names
+        self.nfresh = 0
+        # id() of dict literals whose key order is observed, see ordered_dicts
+        self.ordered = set()
+        # names declared global in some function
+        self.globals = set()
 
     def visit_all(self, nodes):
         for node in nodes:
@@ -73,6 +106,20 @@ class PyLua(ast.NodeVisitor):
             self.emit(orelse)
 
     def visit(self, node):
+        if id(node) in self.loopsubst:
+            # loop invariant, hoisted by visit_loop (or fused loop, see hoist_fused)
+            self.emit(self.loopsubst[id(node)])
+            return
+        if isinstance(node, ast.stmt):
+            hoisted = self.hoist_fused(node)
+            super(PyLua, self).visit(node)
+            if hoisted:
+                self.pop_scope()
+                self.indent()
+                self.emit('end\n')
+            for key in hoisted:
+                del self.loopsubst[key]
+            return
         super(PyLua, self).visit(node)
 
     def visit_Print(self, node):
@@ -81,7 +128,21 @@ class PyLua(ast.NodeVisitor):
         self.emit(')')
 
     def visit_Num(self, node):
-        self.emit(repr(node.n))
+        if isinstance(node.n, numbers.Integral) and abs(node.n) > self.max_native_int():
+            # too big for a native number: arbitrary-precision from the start
+            self.emit("PYLUA.bigint('%d')" % node.n)
+        elif isinstance(node.n, numbers.Integral):
+            self.emit('%d' % node.n)  # no 'L' for Python 2 longs
+        else:
+            self.emit(repr(node.n))
+
+    def unpack(self):
+        # a global in Lua 5.1 (and LuaJIT), moved into table in 5.2
+        return 'unpack' if self.lua_version < (5, 2) else 'table.unpack'
+
+    def max_native_int(self):
+        # Lua 5.3+ has int64 integers, older Luas (and LuaJIT) exact doubles only
+        return 2**63-1 if self.lua_version >= (5, 3) else 2**53
 
     def visit_Add(self, node):
         self.emit('+')
@@ -93,22 +154,43 @@ class PyLua(ast.NodeVisitor):
         self.emit('-')
 
     def visit_Return(self, node):
+        fused = node.value is not None and self.fusion(node.value)
+        if fused:
+            self.indent()
+            self.emit('do\n')
+            self.push_scope()
+            self.emit_fused(fused, 'return %s', 'break')
+            self.pop_scope()
+            self.indent()
+            self.emit('end\n')
+            return
         self.indent()
         self.emit('return ')
-        self.generic_visit(node)
+        if isinstance(node.value, ast.Tuple) and self.functions and \
+                id(self.functions[-1]) in self.multireturn_defs:
+            self.visit_all_sep(node.value.elts, ', ')
+        else:
+            self.generic_visit(node)
         self.eol()
 
-    def visit_FunctionDef(self, node):
+    def visit_FunctionDef(self, node, wrap=None):
         v = dict(body='foo')
         v.update(**vars(node))
 
         self.emit('\n')
 
         self.env_push()
+        self.functions.append(node)
         self.indent()
-        self.emit('%(name)s = function(' % v)
+        self.emit('%(name)s = ' % v)
+        if wrap:
+            self.emit(wrap + '(')
+        self.emit('function(')
         self.visit(node.args)
         self.emit(')\n')
+        for arg in node.args.args:
+            # parameters shadow whatever outer scopes know about the name
+            self.env_bind(getattr(arg, 'arg', None) or arg.id)
 
         self.push_scope()
         default0 = len(node.args.args)-len(node.args.defaults)
@@ -128,22 +210,72 @@ class PyLua(ast.NodeVisitor):
 
         #self.emit('\n')
         self.indent()
-        self.emit('end\n')
+        self.emit('end)\n' if wrap else 'end\n')
+        self.functions.pop()
         self.env_pop()
 
+    def visit_AsyncFunctionDef(self, node):
+        # calling it creates a task, run as a Lua coroutine by the PYLUA scheduler
+        self.visit_FunctionDef(node, 'PYLUA.async')
+
+    def visit_Await(self, node):
+        self.emit_std('PYLUA.await')
+        self.emit('(')
+        self.visit(node.value)
+        self.emit(')')
+
     def visit_Lambda(self, node):
         self.emit('function(')
         # TODO: instead of node.args.args, create and use common method visit_arguments ?
         self.visit_all_sep(node.args.args, ', ')
+        if self.fused_calls([node.body]):
+            # room for the fused loops in front of the return
+            self.emit(')\n')
+            self.push_scope()
+            hoisted = self.hoist_fused_in([node.body])
+            self.indent()
+            self.emit('return ')
+            self.visit(node.body)
+            self.eol()
+            for key in hoisted:
+                del self.loopsubst[key]
+            self.pop_scope()
+            self.indent()
+            self.emit('end')
+            return
         self.emit(') return ')
         self.visit(node.body)
         self.emit(' end')
 
     ident_re = re.compile(r'^[A-Za-z_][\w_]*$')
 
+    # Python modules implemented by the PYLUA runtime itself
+    runtime_modules = {'asyncio'}
+
+    # literals with more entries than this are built chunk by chunk, each in a
+    # function of its own, to stay below Lua's per-function constant limits
+    literal_chunk = 4096
+
     def visit_Dict(self, node):
+        items = list(zip(node.keys, node.values))
+        if id(node) in self.ordered:
+            # insertion-ordered: the number of entries, then keys and values
+            # interleaved, in order; # would stop at a None value
+            flat = ast.List([x for item in items for x in item], ast.Load())
+            self.emit_std('PYLUA.odict')
+            self.emit('(%d, ' % len(items))
+            self.visit_List(flat)
+            self.emit(')')
+            return
+        if len(items) > self.literal_chunk:
+            self.visit_chunked(items, self.visit_dict_items, 'for k, v in pairs(chunk) do t[k] = v end')
+            return
         self.emit('{ ')
-        for k,v in zip(node.keys, node.values):
+        self.visit_dict_items(items)
+        self.emit('}')
+
+    def visit_dict_items(self, items):
+        for k,v in items:
             if isinstance(k, ast.Str) and self.ident_re.match(k.s):
                 # optimize pretty keys
                 self.emit(k.s)
@@ -154,13 +286,49 @@ class PyLua(ast.NodeVisitor):
             self.emit('=')
             self.visit(v)
             self.emit(', ')
-        self.emit('}')
 
     def visit_List(self, node):
+        if len(node.elts) > self.literal_chunk:
+            # by index: ipairs would stop at the first None
+            self.visit_chunked(node.elts, lambda elts: self.visit_all_sep(elts, ', '),
+                               'for j = 1, size do t[n+j] = chunk[j] end; n = n+size')
+            return
         self.emit('{')
         self.visit_all_sep(node.elts, ', ')
         self.emit('}')
 
+    def visit_chunked(self, items, visit_items, copy_chunk):
+        # load time and memory stay linear: every chunk is garbage once copied;
+        # chunks are passed as size, function() return {...} end
+        self.emit('(function(chunks)\n')
+        self.push_scope()
+        self.indent()
+        self.emit('local t, n = {}, 0\n')
+        self.indent()
+        self.emit('for i = 1, #chunks, 2 do\n')
+        self.push_scope()
+        self.indent()
+        self.emit('local size, chunk = chunks[i], chunks[i+1]()\n')
+        self.indent()
+        self.emit(copy_chunk + '\n')
+        self.pop_scope()
+        self.indent()
+        self.emit('end\n')
+        self.indent()
+        self.emit('return t\n')
+        self.pop_scope()
+        self.indent()
+        self.emit('end)({\n')
+        self.push_scope()
+        for i in range(0, len(items), self.literal_chunk):
+            self.indent()
+            self.emit('%d, function() return {' % len(items[i:i+self.literal_chunk]))
+            visit_items(items[i:i+self.literal_chunk])
+            self.emit('} end,\n')
+        self.pop_scope()
+        self.indent()
+        self.emit('})')
+
     def visit_arg(self, node):
         self.emit(node.arg)
 
@@ -170,7 +338,8 @@ class PyLua(ast.NodeVisitor):
 
     def visit_Print(self, node):
         self.indent()
-        self.emit('PYLUA.print(')
+        self.emit_std('PYLUA.print')
+        self.emit('(')
         self.visit_all_sep(node.values, ', ')
         if node.nl:
             if len(node.values)>0:
@@ -213,14 +382,36 @@ class PyLua(ast.NodeVisitor):
             self.pop_scope()
 
     def visit_BinOp(self, node):
-        if isinstance(node.op, ast.Pow):
-            self.emit('math.pow(')
+        if isinstance(node.op, ast.Pow) and self.is_float(node.left, node.right) and \
+                self.lua_version < (5, 3):
+            self.emit_std('math.pow')
+            self.emit('(')
+            self.visit(node.left)
+            self.emit(', ')
+            self.visit(node.right)
+            self.emit(')')
+        elif isinstance(node.op, ast.Pow) and self.is_float(node.left, node.right):
+            # math.pow is gone in Lua 5.3
+            self.emit('(')
+            self.visit(node.left)
+            self.emit('^')
+            self.visit(node.right)
+            self.emit(')')
+        elif isinstance(node.op, tuple(self.checked_ops)) and \
+                not (isinstance(node.op, ast.Mod) and isinstance(node.left, ast.Str)) and \
+                not (isinstance(node.op, ast.Add) and isinstance(node.left, ast.Str)) and \
+                not self.is_float(node.left, node.right):
+            # integer fast path, promoted to PYLUA.bigint on overflow; also
+            # exact floor division and modulo for bigints
+            self.emit_std(self.checked_ops[type(node.op)])
+            self.emit('(')
             self.visit(node.left)
             self.emit(', ')
             self.visit(node.right)
             self.emit(')')
         elif isinstance(node.op, ast.Mod) and isinstance(node.left, ast.Str):
-            self.emit('string.format(')
+            self.emit_std('string.format')
+            self.emit('(')
             self.visit(node.left)
             self.emit(', ')
             if isinstance(node.right, ast.Tuple):
@@ -234,6 +425,14 @@ class PyLua(ast.NodeVisitor):
             self.emit('%')
             self.visit(node.right)
             self.emit(')')
+        elif isinstance(node.op, ast.FloorDiv) and self.lua_version < (5, 3):
+            # floors towards -inf like Python, also for negatives
+            self.emit_std('math.floor')
+            self.emit('(')
+            self.visit(node.left)
+            self.emit('/')
+            self.visit(node.right)
+            self.emit(')')
         elif isinstance(node.op, ast.FloorDiv):
             self.emit('(')
             self.visit(node.left)
@@ -253,6 +452,18 @@ class PyLua(ast.NodeVisitor):
             self.visit(node.right)
             self.emit_paren_maybe(node, node.right, ')', True)
 
+    # integer operators which need a check for overflow (or bigint operands)
+    checked_ops = {ast.Add: 'PYLUA.add', ast.Sub: 'PYLUA.sub', ast.Mult: 'PYLUA.mul',
+                   ast.Pow: 'PYLUA.pow', ast.FloorDiv: 'PYLUA.floordiv', ast.Mod: 'PYLUA.mod'}
+
+    def is_float(self, *nodes):
+        for x in nodes:
+            if isinstance(x, ast.Num) and isinstance(x.n, float):
+                return True
+            if isinstance(x, ast.UnaryOp) and self.is_float(x.operand):
+                return True
+        return False
+
     def visit_BoolOp(self, node):
         first = True
         for x in node.values:
@@ -284,8 +495,20 @@ class PyLua(ast.NodeVisitor):
         self.visit(node.orelse)
 
     def visit_Call(self, node):
+        fused = self.fusion(node)
+        if fused:
+            # only where hoist_fused could not put the loop in front of the
+            # statement (lambdas, comprehension elements, ...): run it in a function
+            self.emit('(function()\n')
+            self.push_scope()
+            self.emit_fused(fused, 'return %s', 'return %s')
+            self.pop_scope()
+            self.indent()
+            self.emit('end)()')
+            return
         if isinstance(node.func, ast.Attribute) and node.func.attr == 'append':
-            self.emit('table.insert(')
+            self.emit_std('table.insert')
+            self.emit('(')
             self.visit(node.func.value)
             self.emit(', ')
             self.visit_all_sep(node.args, ', ')
@@ -297,22 +520,23 @@ class PyLua(ast.NodeVisitor):
             if isinstance(arg, ast.Call) and isinstance(arg.func, ast.Attribute) and \
                     arg.func.attr == 'split' and len(arg.args)==0:
                 # ' '.join(sss.split())
-                self.emit('string.gsub(')
+                self.emit_std('string.gsub')
+                self.emit('(')
                 self.visit(arg.func.value)
                 self.emit(", '%s+', ")
                 self.visit(node.func.value)
                 self.emit(')')
                 return
-            self.emit('table.concat(')
-            self.visit(node.args[0])
+            self.emit_std('table.concat')
+            self.emit('(')
+            self.visit_sequence(node.args[0])
             self.emit(', ')
             self.visit(node.func.value)
             self.emit(')')
             return
         if isinstance(node.func, ast.Attribute) and \
                 node.func.attr == "lower":
-            self.emit('string.')
-            self.emit(node.func.attr)
+            self.emit_std('string.' + node.func.attr)
             self.emit('(')
             self.visit(node.func.value)
             if len(node.keywords)>0:
@@ -324,12 +548,19 @@ class PyLua(ast.NodeVisitor):
                 self.visit_all_sep(node.args, ', ')
             self.emit(')')
             return
+        if self.view_of(node):
+            # a view used as a value (assigned, passed on, joined) may be indexed or
+            # given to code expecting a sequence: copy it into a list there
+            self.emit_std('PYLUA.list')
+            self.emit('(')
+            self.visit_view(node)
+            self.emit(')')
+            return
         if isinstance(node.func, ast.Attribute) and \
                 node.func.attr in ['keys', 'replace', 'split', 'update', 'copy',
                                    'endswith', 'find', 'lower', 'setdefault', 'strip',
-                                   'startswith', 'join', 'items', 'sort']:
-            self.emit('PYLUA.')
-            self.emit(node.func.attr)
+                                   'startswith', 'join', 'items']:
+            self.emit_std('PYLUA.' + node.func.attr)
             self.emit('(')
             self.visit(node.func.value)
             if len(node.keywords)>0:
@@ -341,6 +572,41 @@ class PyLua(ast.NodeVisitor):
                 self.visit_all_sep(node.args, ', ')
             self.emit(')')
             return
+        if (isinstance(node.func, ast.Attribute) and node.func.attr == 'sort') or \
+                (isinstance(node.func, ast.Name) and node.func.id == 'sorted' and
+                 len(node.args)>=1):
+            # PYLUA.sort(list, key, reverse) sorts in place, PYLUA.sorted returns a
+            # new list; both compute every key only once and are stable
+            if isinstance(node.func, ast.Attribute):
+                self.emit_std('PYLUA.sort')
+                self.emit('(')
+                self.visit(node.func.value)
+                args = node.args
+            else:
+                self.emit_std('PYLUA.sorted')
+                self.emit('(')
+                self.visit_sequence(node.args[0])
+                args = node.args[1:]
+            # Python 2 passes cmp, key, reverse positionally
+            keywords = dict(zip(('cmp', 'key', 'reverse'), args))
+            keywords.update((k.arg, k.value) for k in node.keywords)
+            if 'cmp' in keywords and self.text(keywords['cmp']) == 'nil':
+                del keywords['cmp']
+            if not set(keywords) <= {'key', 'reverse'}:
+                # cmp: a comparison, not a key function
+                self.emit(', PYLUA.keywords{')
+                self.visit_all_sep([ast.keyword(k, keywords[k]) for k in
+                                    ('cmp', 'key', 'reverse') if k in keywords], ', ')
+                self.emit('})')
+                return
+            if keywords:
+                self.emit(', ')
+                self.visit_or(keywords.get('key'), 'nil')
+            if 'reverse' in keywords:
+                self.emit(', ')
+                self.visit(keywords['reverse'])
+            self.emit(')')
+            return
         if isinstance(node.func, ast.Attribute) and node.func.attr == 'get' and \
                 len(node.args)>=1 and len(node.args)<=2:
             self.visit(node.func.value)
@@ -353,6 +619,47 @@ class PyLua(ast.NodeVisitor):
                 self.emit(' or ')
                 self.visit(node.args[1])
             return
+        if isinstance(node.func, ast.Name) and node.func.id == 'len' and len(node.args)==1 and \
+                isinstance(node.args[0], ast.Subscript) and isinstance(node.args[0].slice, ast.Slice) and \
+                not node.args[0].slice.step:
+            # len(x[a:b]) --> computed from bounds, no copy
+            sub = node.args[0]
+            self.emit_std('PYLUA.slicelen')
+            self.emit('(')
+            self.visit(sub.value)
+            self.emit(', ')
+            self.visit_or(sub.slice.lower, 'nil')
+            self.emit(', ')
+            self.visit_or(sub.slice.upper, 'nil')
+            self.emit(')')
+            return
+        if isinstance(node.func, ast.Name) and node.func.id == 'len' and len(node.args)==1 and \
+                self.view_of(node.args[0]):
+            # live size of the dict, no list built
+            self.emit_std('PYLUA.len')
+            self.emit('(')
+            self.visit(self.view_of(node.args[0])[1])
+            self.emit(')')
+            return
+        if isinstance(node.func, ast.Name) and node.func.id in ('list', 'tuple') and \
+                len(node.args)==1 and self.expr_type(node.args[0]) == 'set':
+            self.visit_sequence(node.args[0])
+            return
+        if isinstance(node.func, ast.Name) and node.func.id in ('list', 'tuple') and \
+                len(node.args)==1 and self.view_of(node.args[0]):
+            self.emit_std('PYLUA.list')
+            self.emit('(')
+            self.visit_view(node.args[0])
+            self.emit(')')
+            return
+        if isinstance(node.func, ast.Name) and node.func.id == 'len' and len(node.args)==1 and \
+                self.expr_type(node.args[0]) in ('set', 'dict', 'odict'):
+            # keys, not a sequence: # would not count them
+            self.emit_std('PYLUA.len')
+            self.emit('(')
+            self.visit(node.args[0])
+            self.emit(')')
+            return
         if isinstance(node.func, ast.Name) and node.func.id == 'len' and len(node.args)==1:
             noparen = isinstance(node.args[0], ast.Attribute) or isinstance(node.args[0], ast.Name)
             self.emit('#')
@@ -360,10 +667,30 @@ class PyLua(ast.NodeVisitor):
             self.visit(node.args[0])
             if not noparen: self.emit(')')
             return
+        if isinstance(node.func, ast.Name) and node.func.id in ('set', 'frozenset') and \
+                len(node.args)<=1:
+            if len(node.args)==0:
+                self.emit('{}')
+            elif isinstance(node.args[0], (ast.List, ast.Tuple, ast.Set)):
+                self.visit_Set(node.args[0])
+            else:
+                self.emit_std('PYLUA.set')
+                self.emit('(')
+                self.visit(node.args[0])
+                self.emit(')')
+            return
+        if isinstance(node.func, ast.Name) and node.func.id == 'dict' and \
+                not node.args and not node.keywords:
+            if id(node) in self.ordered:
+                self.emit_std('PYLUA.odict')
+                self.emit('(0, {})')
+                return
+            self.emit('{}')
+            return
         stdfuncs = {'max':'math.max', 'min':'math.min', 'ord':'PYLUA.ord', 'str':'tostring',
                     'map':'PYLUA.map', 'sum':'PYLUA.sum', 'open':'PYLUA.open'}
         if isinstance(node.func, ast.Name) and node.func.id in list(stdfuncs.keys()):
-            self.emit(stdfuncs[node.func.id])
+            self.emit_std(stdfuncs[node.func.id])
             self.emit('(')
             self.visit_all_sep(node.args, ', ')
             self.emit(')')
@@ -401,33 +728,121 @@ class PyLua(ast.NodeVisitor):
         self.visit_all(node.comparators)
 
     def visit_Subscript(self, node):
-        if isinstance(node.slice, ast.Index):
+        if isinstance(node.slice, ast.Slice):
+            self.visit_slice(node.value, node.slice)
+        elif isinstance(node.slice, ast.ExtSlice):
+            self.emit('[ ? ]')
+        else:
+            # Python 3.9+ drops the ast.Index wrapper
+            index = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
             self.visit(node.value)
             self.emit('[')
-            if isinstance(node.slice.value, ast.Num):
-                self.emit('%d' % (node.slice.value.n + 1))
-            elif isinstance(node.slice.value, ast.Tuple):
+            if isinstance(index, ast.Num) and self.expr_type(node.value) not in ('dict', 'odict'):
+                self.emit('%d' % (index.n + 1))
+            elif isinstance(index, ast.Tuple):
                 self.emit('PYLUA.keytuple')
-                self.visit(node.slice)
+                self.visit(index)
             else:
-                self.visit(node.slice)
+                self.visit(index)
             self.emit(']')
-        elif isinstance(node.slice, ast.Slice):
-            # TODO: PYLUA.slice because other for string vs. table
-            self.emit('PYLUA.slice(')
-            self.visit(node.value)
+
+    def visit_slice(self, value, slc):
+        lower = self.const_int(slc.lower) if slc.lower else 0
+        upper = self.const_int(slc.upper) if slc.upper else None
+        constant = lower is not None and (upper is not None or not slc.upper) and not slc.step
+        kind = self.expr_type(value)
+        if constant and kind == 'str':
+            # x[a:b] --> string.sub(x, a+1, b), offsets resolved here
+            self.emit_std('string.sub')
+            self.emit('(')
+            self.visit(value)
+            self.emit(', %d' % (lower+1 if lower >= 0 else lower))
+            if upper is not None:
+                self.emit(', %d' % (upper if upper >= 0 else upper-1))
+            self.emit(')')
+        elif constant and kind == 'list' and self.lua_version >= (5, 3) and \
+                isinstance(value, ast.Name):
+            # x[a:b] --> table.move(x, a+1, b, 1, {})
+            self.emit_std('table.move')
+            self.emit('(')
+            self.visit(value)
+            if lower >= 0:
+                self.emit(', %d, ' % (lower+1))
+            else:
+                # Python clamps x[-5:] to the start of a shorter list
+                self.emit(', ')
+                self.emit_std('math.max')
+                self.emit('(1, #')
+                self.visit(value)
+                self.emit('%+d), ' % (lower+1))
+            if upper is None:
+                self.emit('#')
+                self.visit(value)
+            elif upper >= 0:
+                self.emit('%d' % upper)
+            else:
+                self.emit('#')
+                self.visit(value)
+                self.emit('%+d' % upper)
+            self.emit(', 1, {})')
+        else:
+            self.emit_std('PYLUA.slice')
+            self.emit('(')
+            self.visit(value)
             self.emit(', ')
-            self.visit_or(node.slice.lower, 'nil')
+            self.visit_or(slc.lower, 'nil')
             self.emit(', ')
-            self.visit_or(node.slice.upper, 'nil')
-            if node.slice.step:
+            self.visit_or(slc.upper, 'nil')
+            if slc.step:
                 self.emit(', ')
-                self.visit(node.step)
+                self.visit(slc.step)
             self.emit(')')
-        else:
-            self.emit('[ ? ]')
+
+    def const_int(self, node):
+        if isinstance(node, ast.Num) and isinstance(node.n, numbers.Integral):
+            return node.n
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            n = self.const_int(node.operand)
+            if n is not None:
+                return -n
+        return None
+
+    def expr_type(self, node):
+        # FIXME: leaky heuristic; only what is obvious from the syntax
+        if isinstance(node, ast.Str):
+            return 'str'
+        if isinstance(node, (ast.List, ast.ListComp, ast.Tuple)):
+            return 'list'
+        if isinstance(node, (ast.Set, ast.SetComp)):
+            return 'set'
+        if isinstance(node, ast.Dict) or isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Name) and node.func.id == 'dict':
+            return 'odict' if id(node) in self.ordered else 'dict'
+        if isinstance(node, ast.Name):
+            return self.env_type(node.id)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            left = self.expr_type(node.left)
+            if left in ('str', 'list') and left == self.expr_type(node.right):
+                return left
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod) and \
+                isinstance(node.left, ast.Str):
+            return 'str'
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return {'str':'str', 'list':'list', 'sorted':'list', 'tuple':'list',
+                    'set':'set', 'frozenset':'set'}.get(node.func.id)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if node.func.attr in ('lower', 'upper', 'strip', 'replace', 'join', 'format'):
+                return 'str'
+            if node.func.attr == 'split':
+                return 'list'
+        if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Slice):
+            return self.expr_type(node.value)
+        return None
 
     def visit_Tuple(self, node):
+        if len(node.elts) > self.literal_chunk:
+            self.visit_List(node)
+            return
         self.emit('{')
         self.visit_all_sep(node.elts, ', ')
         self.emit('}')
@@ -455,14 +870,40 @@ class PyLua(ast.NodeVisitor):
                 self.eol()
                 self.indent()
             self.visit_all_sep(node.targets[0].elts, ', ')
-            self.emit(' = unpack(')
-            self.visit(node.value)
-            self.emit(')\n')
+            n = len(node.targets[0].elts)
+            if isinstance(node.value, ast.Tuple) and len(node.value.elts) == n and \
+                    not any(x.__class__.__name__ == 'Starred' for x in node.value.elts):
+                # a, b = b, a: Lua evaluates all of the right side first, too
+                self.emit(' = ')
+                self.visit_all_sep(node.value.elts, ', ')
+                self.eol()
+            elif self.multireturn.get(self.called_name(node.value)) == n:
+                self.emit(' = ')
+                self.visit(node.value)
+                self.eol()
+            else:
+                self.emit(' = %s(' % self.unpack())
+                self.visit(node.value)
+                self.emit(')\n')
         elif len(node.targets) > 1:
             # TODO: can there be >1 targets? what's difference with 1 target, a Tuple?
             self.emit('-- PYLUA.FIXME Assign\n')
         else:
             x = node.targets[0]
+            fused = self.fusion(node.value)
+            if fused:
+                if isinstance(x, ast.Name) and not self.env_has(x.id) and self.indentation > 0:
+                    self.emit('local ')
+                    self.visit(x)
+                    self.eol()
+                    self.indent()
+                self.emit('do\n')
+                self.push_scope()
+                self.emit_fused(fused, self.text(x) + ' = %s', 'break')
+                self.pop_scope()
+                self.indent()
+                self.emit('end\n')
+                return
             if isinstance(x, ast.Name) and not self.env_has(x.id):
                 # is it global or local? 
                 if self.indentation > 0:
@@ -471,11 +912,18 @@ class PyLua(ast.NodeVisitor):
             self.emit(' = ')
             self.visit(node.value)
             self.eol()
+            if isinstance(x, ast.Name):
+                self.env_settype(x.id, self.expr_type(node.value))
 
     def visit_AugAssign(self, node):
         self.indent()
         self.visit(node.target)
         self.emit(' = ')
+        if isinstance(node.op, tuple(self.checked_ops)):
+            # same lowering as the binary operator
+            self.visit(ast.BinOp(node.target, node.op, node.value))
+            self.eol()
+            return
         self.visit(node.target)
         fakeParent = ast.BinOp(node.value, node.op, node.value)
         self.visit(node.op)
@@ -493,7 +941,8 @@ class PyLua(ast.NodeVisitor):
                 self.eol()
         else:
             self.indent()
-            self.visit(node.value)
+            if not self.visit_set_method(node.value):
+                self.visit(node.value)
             self.eol()  # TODO: yes, or no?
 
     def visit_Import(self, node):
@@ -504,9 +953,23 @@ class PyLua(ast.NodeVisitor):
                 if x.asname:
                     self.emit(x.asname)
                     self.nocolon.add(x.asname)
+                elif '.' in x.name:
+                    # import a.b.c binds a, with the submodules as fields
+                    parts = x.name.split('.')
+                    self.emit('%s = %s or {}\n' % (parts[0], parts[0]))
+                    self.nocolon.add(parts[0])
+                    for i in range(2, len(parts)):
+                        self.indent()
+                        prefix = '.'.join(parts[:i])
+                        self.emit('%s = %s or {}\n' % (prefix, prefix))
+                    self.indent()
+                    self.emit(x.name)
                 else:
                     self.emit(x.name)
                     self.nocolon.add(x.name)
+                if x.name in self.runtime_modules:
+                    self.emit(' = PYLUA.' + x.name + '\n')
+                    continue
                 self.emit(" = require('")
                 self.emit(x.name)
                 self.emit("')\n")
@@ -524,6 +987,10 @@ class PyLua(ast.NodeVisitor):
                 else:
                     self.emit(x.name)
                     self.nocolon.add(x.name)
+                if node.module in self.runtime_modules:
+                    self.emit(' = PYLUA.' + node.module + '.' + x.name)
+                    self.eol()
+                    continue
                 self.emit(" = require('")
                 self.emit(node.module)
                 self.emit("').")
@@ -544,7 +1011,7 @@ class PyLua(ast.NodeVisitor):
         for x in node.body:
             if isinstance(x, ast.Expr):
                 self.visit(x)
-            elif isinstance(x, ast.FunctionDef):
+            elif isinstance(x, (ast.FunctionDef, getattr(ast, 'AsyncFunctionDef', ast.FunctionDef))):
                 self.visit(x)
                 self.indent()
                 self.emit(';\n')
@@ -580,7 +1047,8 @@ class PyLua(ast.NodeVisitor):
             self.pop_scope()
 
             if node.orelse:
-                if len(node.orelse)==1 and isinstance(node.orelse[0], ast.If):
+                if len(node.orelse)==1 and isinstance(node.orelse[0], ast.If) and \
+                        not self.fused_calls([node.orelse[0].test]):
                     # optimize elif into 'elseif'
                     self.indent()
                     self.emit('elseif ')
@@ -597,12 +1065,26 @@ class PyLua(ast.NodeVisitor):
         self.emit('end\n')
 
     def visit_While(self, node):
-        self.indent()
-        self.emit('while ')
-        self.visit(node.test)
-        self.emit(' do\n')
+        self.visit_loop(node, self.visit_while_loop)
 
-        self.push_scope()
+    def visit_while_loop(self, node):
+        self.indent()
+        if self.fused_calls([node.test]):
+            # the fused loops in the test run before every iteration
+            self.emit('while true do\n')
+            self.push_scope()
+            hoisted = self.hoist_fused_in([node.test])
+            self.indent()
+            self.emit('if not (')
+            self.visit(node.test)
+            self.emit(') then break end\n')
+            for key in hoisted:
+                del self.loopsubst[key]
+        else:
+            self.emit('while ')
+            self.visit(node.test)
+            self.emit(' do\n')
+            self.push_scope()
         self.visit_all(node.body)
         wantcontinue = {i for i in self.wantcontinue if i>=self.indentation}
         if len(wantcontinue) > 0:
@@ -619,22 +1101,63 @@ class PyLua(ast.NodeVisitor):
         self.indent()
         self.emit('break\n')
 
-    def visit_For(self, node):
+    def visit_For(self, node, iterfunc='ipairs'):
+        self.visit_loop(node, self.visit_for_loop, iterfunc)
+
+    def visit_for_loop(self, node, iterfunc):
         self.env_push()  # TODO: is this correct?
+        for x in ast.walk(node.target):
+            if isinstance(x, ast.Name):
+                self.env_bind(x.id)
         self.indent()
         ituple = None
-        if node.target and node.iter and \
-                isinstance(node.iter, ast.Call) and \
-                isinstance(node.iter.func, ast.Attribute) and \
-                node.iter.func.attr == 'items':
-            # Python: for k,v in dict.items():
+        ipair = None
+        if iterfunc == 'ipairs' and node.target and self.view_of(node.iter):
+            # Python: for k,v in dict.items():  (or keys(), values())
+            view, value = self.view_of(node.iter)
             self.emit('for ')
-            if isinstance(node.target, ast.Tuple):
+            if view == 'values':
+                self.emit('_, ')
+            if view == 'items' and isinstance(node.target, ast.Tuple):
                 self.visit_all_sep(node.target.elts, ', ')
+            elif view == 'items':
+                ipair = node.target
+                self.emit('PYLUA_k, PYLUA_v')
+            else:
+                self.visit(node.target)
+            # insertion order for PYLUA.odict, next() for plain tables
+            self.emit(' in PYLUA.opairs(')
+            self.visit(value)
+            self.emit(') do\n')
+        elif iterfunc == 'ipairs' and node.target and self.expr_type(node.iter) == 'odict':
+            # Python: for k in dict:
+            self.emit('for ')
+            self.visit(node.target)
+            self.emit(' in PYLUA.opairs(')
+            self.visit(node.iter)
+            self.emit(') do\n')
+        elif iterfunc == 'ipairs' and node.target and isinstance(node.iter, ast.Subscript) and \
+                isinstance(node.iter.slice, ast.Slice) and not node.iter.slice.step:
+            # Python: for x in tab[a:b]:  -- iterate in place, no copy
+            self.emit('for _, ')
+            if isinstance(node.target, ast.Tuple):
+                ituple = node.target
+                self.emit('PYLUA_x')
             else:
                 self.visit(node.target)
+            self.emit(' in PYLUA.islice(')
+            self.visit(node.iter.value)
+            self.emit(', ')
+            self.visit_or(node.iter.slice.lower, 'nil')
+            self.emit(', ')
+            self.visit_or(node.iter.slice.upper, 'nil')
+            self.emit(') do\n')
+        elif iterfunc == 'ipairs' and node.target and self.expr_type(node.iter) == 'set':
+            # Python: for x in someset:  -- members are the keys
+            self.emit('for ')
+            self.visit(node.target)
             self.emit(' in pairs(')
-            self.visit(node.iter.func.value)
+            self.visit(node.iter)
             self.emit(') do\n')
         # TODO: for c in range(len(tab)):  --> for c = 1,#tab:
         # TODO: for c in range(a, b):      --> for c = a,b-1: ???
@@ -645,7 +1168,7 @@ class PyLua(ast.NodeVisitor):
                 self.emit('PYLUA_x')
             else:
                 self.visit(node.target)
-            self.emit(' in ipairs(')
+            self.emit(' in %s(' % iterfunc)
             self.visit(node.iter)
             self.emit(') do\n')
         else:
@@ -656,7 +1179,12 @@ class PyLua(ast.NodeVisitor):
             self.indent()
             self.emit('local ')
             self.visit_all_sep(ituple.elts, ', ')
-            self.emit(' = unpack(PYLUA_x)\n')
+            self.emit(' = %s(PYLUA_x)\n' % self.unpack())
+        if ipair:
+            self.indent()
+            self.emit('local ')
+            self.visit(ipair)
+            self.emit(' = {PYLUA_k, PYLUA_v}\n')
         self.visit_all(node.body)
         wantcontinue = {i for i in self.wantcontinue if i>=self.indentation}
         if len(wantcontinue) > 0:
@@ -678,6 +1206,226 @@ class PyLua(ast.NodeVisitor):
             self.visit_all(node.orelse)
             self.pop_scope()
 
+    def visit_AsyncFor(self, node):
+        # every step awaits __anext__, so this must run inside a task
+        self.visit_For(node, 'PYLUA.aiter')
+
+    def visit_loop(self, node, visit_loop, *args):
+        hoisted, subst = self.loop_invariants(node)
+        outermost = self.loopstd is None
+        if outermost:
+            # which library functions it uses is known after the loop only
+            stream = self.stream
+            self.stream = io.StringIO()
+            self.loopstd = {}
+        elif hoisted:
+            self.indent()
+            self.emit('do\n')
+        if hoisted:
+            # a block of its own, Lua allows no more than 200 locals per function
+            self.push_scope()
+        for name, expr, guard in hoisted:
+            self.indent()
+            self.emit('local %s = ' % name)
+            if guard:
+                # the loop may not evaluate it at all, so don't fail on nil here
+                for i in range(1, len(guard)):
+                    self.emit('.'.join(guard[:i]) + ' and ')
+            self.visit(expr)
+            self.eol()
+        self.loopsubst.update(subst)
+        visit_loop(node, *args)
+        for key in subst:
+            del self.loopsubst[key]
+        if hoisted:
+            self.pop_scope()
+
+        if outermost:
+            loop = self.stream.getvalue()
+            self.stream = stream
+            std = sorted(self.loopstd.items())
+            self.loopstd = None
+            if std and not hoisted:
+                loop = ''.join('  ' + line if line.strip() else line
+                               for line in loop.splitlines(True))
+            if std or hoisted:
+                self.indent()
+                self.emit('do\n')
+                self.push_scope()
+                for name, func in std:
+                    self.indent()
+                    self.emit('local %s = %s\n' % (name, func))
+                self.pop_scope()
+            self.emit(loop)
+        if hoisted or outermost and std:
+            self.indent()
+            self.emit('end\n')
+
+    def emit_std(self, func):
+        # library function; inside loops it is looked up once, before the loop
+        if self.loopstd is not None and '.' in func:
+            name = 'PYLUA_' + func.replace('PYLUA.', '').replace('.', '_')
+            self.loopstd[name] = func
+            func = name
+        self.emit(func)
+
+    # calls which cannot rebind attributes of their arguments
+    pure_funcs = {'len', 'str', 'int', 'float', 'abs', 'max', 'min', 'ord', 'chr', 'range',
+                  'isinstance', 'repr', 'sum', 'sorted', 'set', 'frozenset', 'tuple', 'list',
+                  'print'}
+    pure_methods = {'append', 'get', 'keys', 'items', 'values', 'split', 'join', 'lower',
+                    'upper', 'strip', 'startswith', 'endswith', 'find', 'replace', 'copy',
+                    'format'}
+
+    def attr_chain(self, node):
+        # a.b.c --> ('a', 'b', 'c'); None for anything else
+        if isinstance(node, ast.Name):
+            return (node.id,)
+        if isinstance(node, ast.Attribute):
+            chain = self.attr_chain(node.value)
+            return chain and chain + (node.attr,)
+        return None
+
+    def loop_invariants(self, node):
+        """
+        Find attribute chains (self.x.y, math.sqrt) and arithmetic on unmodified
+        names that do not change while the loop *node* runs.  Returns the list
+        of (local name, expression, guard chain or None) to hoist in front of the
+        loop, and the id() -> local name substitutions for the loop itself.
+        Any call (other than pure_funcs/pure_methods), await or yield in the
+        loop may change what is reachable from globals, so then only module
+        functions and arithmetic on local names qualify.
+        FIXME: leaky heuristic; objects modified through aliases are not noticed.
+        """
+        parts = list(node.body)
+        if isinstance(node, ast.While):
+            parts.append(node.test)
+        stored = set()
+        stored_chains = set()
+        escaped = set()
+        calls = False
+        if not isinstance(node, ast.While):
+            stored.update(x.id for x in ast.walk(node.target) if isinstance(x, ast.Name))
+        for part in parts:
+            for x in ast.walk(part):
+                if isinstance(x, ast.Name) and not isinstance(x.ctx, ast.Load):
+                    stored.add(x.id)
+                elif isinstance(x, ast.Attribute) and not isinstance(x.ctx, ast.Load):
+                    stored_chains.add(self.attr_chain(x))
+                elif isinstance(x, (ast.FunctionDef, ast.ClassDef)):
+                    stored.add(x.name)
+                elif isinstance(x, (ast.Global, getattr(ast, 'Nonlocal', ast.Global))):
+                    stored.update(x.names)
+                elif isinstance(x, (ast.Import, ast.ImportFrom)):
+                    stored.update((a.asname or a.name).split('.')[0] for a in x.names)
+                elif isinstance(x, ast.Call):
+                    if isinstance(x.func, ast.Name) and x.func.id in self.pure_funcs:
+                        continue
+                    if isinstance(x.func, ast.Attribute) and x.func.attr in self.pure_methods:
+                        continue
+                    calls = True
+                    args = x.args + [k.value for k in x.keywords]
+                    if isinstance(x.func, ast.Attribute):
+                        args.append(x.func.value)
+                    for arg in args:
+                        escaped.update(n.id for n in ast.walk(arg) if isinstance(n, ast.Name))
+                elif x.__class__.__name__ in ('Await', 'Yield', 'YieldFrom'):
+                    calls = True
+
+        def local(name):
+            # a local of the function, which no call can rebind
+            return name not in self.globals and any(name in env for env in self.envs[1:])
+
+        def invariant(chain):
+            if not chain or chain[0] in stored:
+                return False
+            if calls and chain[0] not in self.nocolon:
+                return False
+            if chain[0] in escaped and chain[0] not in self.nocolon:
+                return False
+            return not any(s and s == chain[:len(s)] for s in stored_chains)
+
+        hoisted = []
+        names = {}
+        subst = {}
+        def hoist(x, chain, always):
+            if id(x) in self.loopsubst:
+                return
+            if chain:
+                key = chain
+                name = self.fresh('_'.join(chain))
+            else:
+                key = ast.dump(x)
+                name = self.fresh('inv')
+            if key not in names:
+                # self itself is never nil, but self.a may be in self.a.b
+                safe = always == TEST or chain is None or chain[0] in self.nocolon or \
+                    chain == ('self', chain[-1])
+                names[key] = name
+                hoisted.append((name, x, None if safe else chain))
+            subst[id(x)] = names[key]
+
+        def arith(x):
+            # True when x only combines numbers and unmodified names
+            if isinstance(x, ast.Num):
+                return True
+            if isinstance(x, ast.Name):
+                return x.id not in stored and x.id not in ('None', 'True', 'False') and \
+                    (local(x.id) or not calls)
+            if isinstance(x, ast.BinOp) and isinstance(x.op, (ast.Add, ast.Sub, ast.Mult, ast.Div)):
+                return arith(x.left) and arith(x.right)
+            return False
+
+        # how sure it is that an expression gets evaluated
+        MAYBE, EVERY, TEST = 0, 1, 2  # ... every iteration, ... at least once
+
+        def scan(x, always):
+            if isinstance(x, (ast.FunctionDef, ast.Lambda, ast.ClassDef, ast.GeneratorExp,
+                              ast.ListComp, ast.DictComp, ast.SetComp)):
+                return
+            if isinstance(x, ast.Attribute) and isinstance(x.ctx, ast.Load):
+                chain = self.attr_chain(x)
+                if invariant(chain):
+                    hoist(x, chain, always)
+                    return
+            if isinstance(x, ast.BinOp) and always != MAYBE and arith(x) and \
+                    any(isinstance(y, ast.Name) for y in ast.walk(x)):
+                hoist(x, None, always)
+                return
+            if isinstance(x, ast.Call) and isinstance(x.func, ast.Attribute):
+                chain = self.attr_chain(x.func)
+                if chain and len(chain) == 2 and chain[0] in self.nocolon and invariant(chain):
+                    # module function, e.g. math.sqrt
+                    hoist(x.func, chain, always)
+                else:
+                    scan(x.func.value, always)
+                for y in x.args + [k.value for k in x.keywords]:
+                    scan(y, always)
+                return
+            if isinstance(x, (ast.If, ast.While, ast.For, ast.IfExp)):
+                fields = [x.iter] if isinstance(x, ast.For) else [x.test]
+                for y in fields:
+                    scan(y, always)
+                for y in ast.iter_child_nodes(x):
+                    if y not in fields:
+                        scan(y, MAYBE)
+                return
+            if isinstance(x, ast.BoolOp):
+                scan(x.values[0], always)
+                for y in x.values[1:]:
+                    scan(y, MAYBE)
+                return
+            if x.__class__.__name__ in ('Try', 'TryExcept', 'TryFinally', 'With'):
+                always = MAYBE
+            for y in ast.iter_child_nodes(x):
+                scan(y, always)
+
+        if isinstance(node, ast.While):
+            scan(node.test, TEST)
+        for x in node.body:
+            scan(x, EVERY)
+        return hoisted, subst
+
     def visit_Continue(self, node):
         self.indent()
         self.emit('goto continue\n')
@@ -685,12 +1433,351 @@ class PyLua(ast.NodeVisitor):
         self.wantcontinue.add(self.indentation-1)
         assert 0, "Continue is non-existent in Lua!"
 
+    def text(self, node):
+        # Lua code for *node*, as a string
+        stream = self.stream
+        self.stream = io.StringIO()
+        self.visit(node)
+        rv = self.stream.getvalue()
+        self.stream = stream
+        return rv
+
+    def fresh(self, name):
+        self.nfresh += 1
+        return 'PYLUA_%s%d' % (name, self.nfresh)
+
+    def stream_of(self, node):
+        """
+        The elements of the iterable *node* as (steps, value), without building
+        any table: steps are ('for', header), ('let', statement) or ('if', test)
+        and value the Lua expression for one element (a list of them for
+        tuples).  None when *node* is not a map/filter/zip/generator chain.
+        """
+        if isinstance(node, (ast.GeneratorExp, ast.ListComp)):
+            steps = []
+            for gen in node.generators:
+                inner, value = self.source_of(gen.iter, gen.target)
+                steps += inner
+                if value != self.names_of(gen.target):
+                    steps.append(('let', self.bind(gen.target, value)))
+                steps += [('if', self.text(x)) for x in gen.ifs]
+            return steps, self.text(node.elt)
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name) or node.keywords:
+            return None
+        func = node.func.id
+        if func in ('map', 'filter') and len(node.args) == 2:
+            f = node.args[0]
+            arg = f.args.args[0] if isinstance(f, ast.Lambda) and len(f.args.args) == 1 else None
+            steps, value = self.source_of(node.args[1], arg)
+            if arg:
+                if value != self.names_of(arg):
+                    steps.append(('let', self.bind(arg, value)))
+                result = self.text(f.body)
+            elif isinstance(f, ast.Name) and f.id == 'None' or \
+                    isinstance(f, ast.NameConstant) and f.value is None:
+                result = self.as_value(value)
+            else:
+                arg = ast.Name(id=self.as_value(value), ctx=ast.Load())
+                result = self.text(ast.Call(func=f, args=[arg], keywords=[]))
+            if func == 'map':
+                return steps, result
+            steps.append(('if', result))
+            return steps, value
+        if func == 'zip' and len(node.args) > 0:
+            seqs = [self.fresh('seq') for x in node.args]
+            i = self.fresh('i')
+            steps = [('let', 'local %s = %s' % (', '.join(seqs),
+                                                ', '.join(self.text(x) for x in node.args)))]
+            sizes = ', '.join('#' + x for x in seqs)
+            steps.append(('for', 'for %s = 1, %s do' % (i, sizes if len(seqs) == 1
+                                                        else 'math.min(%s)' % sizes)))
+            return steps, ['%s[%s]' % (x, i) for x in seqs]
+        return None
+
+    def source_of(self, node, target=None):
+        # like stream_of, for any iterable; loops over it directly bind *target*
+        # when they can
+        rv = self.stream_of(node)
+        if rv:
+            return rv
+        names = self.names_of(target)
+        v = names if isinstance(names, str) else self.fresh('v')
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+                node.func.id == 'range' and 1 <= len(node.args) <= 3 and not node.keywords:
+            args = [self.text(x) for x in node.args]
+            if len(args) == 1:
+                args.insert(0, '0')
+            step = self.const_int(node.args[2]) if len(args) == 3 else 1
+            if step:
+                stop = args[1] if re.match(r'^[\w.]+$', args[1]) else '(%s)' % args[1]
+                header = 'for %s = %s, %s%+d' % (v, args[0], stop, -1 if step > 0 else 1)
+                if step != 1:
+                    header += ', %d' % step
+                return [('for', header + ' do')], v
+        if self.view_of(node):
+            view, d = self.view_of(node)
+            k = self.fresh('k')
+            if view == 'items' and isinstance(names, list) and len(names) == 2:
+                k, v = names
+            elif view == 'keys' and isinstance(names, str):
+                k, v = names, self.fresh('v')
+            header = 'for %s, %s in PYLUA.opairs(%s) do' % (k, v, self.text(d))
+            value = {'items':[k, v], 'keys':k, 'values':v}[view]
+            return [('for', header)], value
+        if self.expr_type(node) == 'set':
+            return [('for', 'for %s in pairs(%s) do' % (v, self.text(node)))], v
+        if self.expr_type(node) == 'odict':
+            return [('for', 'for %s in PYLUA.opairs(%s) do' % (v, self.text(node)))], v
+        return [('for', 'for _, %s in ipairs(%s) do' % (v, self.text(node)))], v
+
+    def names_of(self, target):
+        # Lua name(s) a target binds: a string, a list for tuples, else None
+        if isinstance(target, ast.Tuple) and all(isinstance(x, ast.Name) for x in target.elts):
+            return [x.id for x in target.elts]
+        if isinstance(target, ast.Name):
+            return target.id
+        if getattr(target, 'arg', None):
+            return target.arg
+        return None
+
+    def bind(self, target, value):
+        # 'local <target> = <value>'; target is a Name, Tuple or lambda argument
+        if isinstance(target, ast.Tuple):
+            names = ', '.join(self.text(x) for x in target.elts)
+            if isinstance(value, list) and len(value) == len(target.elts):
+                return 'local %s = %s' % (names, ', '.join(value))
+            return 'local %s = %s(%s)' % (names, self.unpack(), self.as_value(value))
+        return 'local %s = %s' % (self.text(target), self.as_value(value))
+
+    def as_value(self, value):
+        return '{%s}' % ', '.join(value) if isinstance(value, list) else value
+
+    def fusion(self, node):
+        """
+        sum/any/all/min/max/str.join over a map/filter/zip/generator chain, as
+        (steps, init, body, result): one loop, no intermediate tables.  body
+        may contain '%(exit)s' where the loop can stop early.
+        """
+        if not isinstance(node, ast.Call) or node.keywords:
+            return None
+        # the loop variables are local to the loop
+        self.env_push()
+        try:
+            return self.fusion_of(node)
+        finally:
+            self.env_pop()
+
+    def fusion_of(self, node):
+        if isinstance(node.func, ast.Attribute) and node.func.attr == 'join' and \
+                isinstance(node.func.value, ast.Str) and len(node.args) == 1:
+            func = 'join'
+        elif isinstance(node.func, ast.Name) and \
+                node.func.id in ('sum', 'any', 'all', 'min', 'max') and len(node.args) == 1:
+            func = node.func.id
+        elif isinstance(node.func, ast.Name) and node.func.id == 'sum' and len(node.args) == 2:
+            func = 'sum'
+        else:
+            return None
+        if func in ('min', 'max', 'join', 'any', 'all') and \
+                not isinstance(node.args[0], (ast.Call, ast.GeneratorExp, ast.ListComp)):
+            # plain iterable, nothing to fuse
+            return None
+        fused = self.stream_of(node.args[0])
+        if not fused:
+            return None
+        steps, value = fused
+        value = self.as_value(value)
+        acc = self.fresh('acc')
+        if func == 'sum':
+            start = self.text(node.args[1]) if len(node.args) == 2 else '0'
+            # checked like any other integer +
+            add = 'PYLUA.add(%s, %s)'
+            if len(node.args) == 2 and self.is_float(node.args[1]):
+                add = '%s + %s'
+            return steps, ['local %s = %s' % (acc, start)], \
+                ['%s = %s' % (acc, add % (acc, value))], acc
+        if func == 'any':
+            return steps, ['local %s = false' % acc], \
+                ['if %s then %s = true; %%(exit)s end' % (value, acc)], acc
+        if func == 'all':
+            return steps, ['local %s = true' % acc], \
+                ['if not (%s) then %s = false; %%(exit)s end' % (value, acc)], acc
+        if func in ('min', 'max'):
+            v = value if self.ident_re.match(value) else self.fresh('v')
+            return steps, ['local %s' % acc], \
+                ['local %s = %s' % (v, value) if v != value else '',
+                 'if %s == nil or %s %s %s then %s = %s end' %
+                 (acc, v, '<' if func == 'min' else '>', acc, acc, v)], acc
+        n = self.fresh('n')
+        return steps, ['local %s, %s = {}, 0' % (acc, n)], \
+            ['%s = %s + 1' % (n, n), '%s[%s] = %s' % (acc, n, value)], \
+            'table.concat(%s, %s)' % (acc, self.text(node.func.value))
+
+    def hoist_fused(self, node):
+        """
+        Run the fused loops (see fusion) in the expressions of the statement
+        *node* in front of it, each into a local of its own: a function around
+        the loop costs a closure per evaluation, which LuaJIT 2.0 does not
+        compile.  The locals and the statement go in a block of their own
+        (do ... end), Lua allows no more than 200 locals per function.
+        Returns the id()s substituted.
+        """
+        if isinstance(node, ast.While):
+            return []  # see visit_while_loop
+        exprs = [node.test] if isinstance(node, ast.Assert) else \
+            [x for x in ast.iter_child_nodes(node) if isinstance(x, ast.expr)]
+        if isinstance(node, ast.Assign):
+            exprs = [node.value] + node.targets  # Python's order
+        if isinstance(node, ast.Return) or \
+                isinstance(node, ast.Assign) and len(node.targets) == 1:
+            # a loop of its own, finished by the statement itself
+            exprs = [x for x in exprs if x is not node.value or not self.fusion(x)]
+        if not self.fused_calls(exprs):
+            return []
+        if isinstance(node, ast.Assign):
+            # new names must outlive the block
+            names = []
+            for target in node.targets:
+                for x in ast.walk(target):
+                    if isinstance(x, ast.Name) and isinstance(x.ctx, ast.Store) and \
+                            not self.env_has(x.id) and x.id not in names:
+                        names.append(x.id)
+            if names and self.indentation > 0:
+                self.indent()
+                self.emit('local %s\n' % ', '.join(names))
+            for name in names:
+                self.env_add(name)
+        self.indent()
+        self.emit('do\n')
+        self.push_scope()
+        return self.hoist_fused_in(exprs)
+
+    def hoist_fused_in(self, exprs):
+        rv = []
+        for call, fused, guard in self.fused_calls(exprs):
+            name = self.fresh(getattr(call.func, 'id', None) or call.func.attr)
+            self.indent()
+            self.emit('local %s\n' % name)
+            self.indent()
+            if guard is None:
+                self.emit('do\n')
+            else:
+                self.emit('if ')
+                self.visit(guard)
+                self.emit(' then\n')
+            self.push_scope()
+            self.emit_fused(fused, name + ' = %s', 'break')
+            self.pop_scope()
+            self.indent()
+            self.emit('end\n')
+            self.loopsubst[id(call)] = name
+            rv.append(id(call))
+        return rv
+
+    def fused_calls(self, exprs):
+        """
+        The fusable calls in *exprs* as (call, fusion, guard), where guard is
+        the condition under which Python evaluates the call, None for always.
+        Calls evaluated repeatedly, under conditions with side effects, or
+        after anything with side effects (in Python's order) are not included:
+        running them first would change the result.
+        """
+        pure_types = (ast.Name, ast.Attribute, ast.Num, ast.Str, ast.Compare, ast.UnaryOp,
+                      ast.BoolOp, ast.BinOp, ast.Subscript, ast.Tuple, ast.List, ast.Slice,
+                      ast.expr_context, ast.cmpop, ast.unaryop, ast.boolop, ast.operator,
+                      getattr(ast, 'Index', ast.Slice), getattr(ast, 'Constant', ast.Num),
+                      getattr(ast, 'NameConstant', ast.Num))
+
+        def pure(x):
+            return all(isinstance(y, pure_types) for y in ast.walk(x))
+
+        def both(guard, test):
+            return test if guard is None else ast.BoolOp(ast.And(), [guard, test])
+
+        rv = []
+        # nothing with side effects evaluated so far
+        state = {'clean': True}
+        def scan(x, guard):
+            fused = isinstance(x, ast.Call) and self.fusion(x)
+            if fused:
+                if state['clean']:
+                    rv.append((x, fused, guard))
+                else:
+                    state['clean'] = pure(x)
+                return
+            if isinstance(x, ast.BoolOp):
+                scan(x.values[0], guard)
+                for i in range(1, len(x.values)):
+                    if not pure(x.values[i-1]):
+                        break
+                    test = x.values[0] if i == 1 else ast.BoolOp(x.op, x.values[:i])
+                    if isinstance(x.op, ast.Or):
+                        test = ast.UnaryOp(ast.Not(), test)
+                    scan(x.values[i], both(guard, test))
+            elif isinstance(x, ast.IfExp):
+                scan(x.test, guard)
+                if pure(x.test):
+                    scan(x.body, both(guard, x.test))
+                    scan(x.orelse, both(guard, ast.UnaryOp(ast.Not(), x.test)))
+            elif isinstance(x, ast.Compare):
+                # the rest of a chain is evaluated only while it holds
+                scan(x.left, guard)
+                scan(x.comparators[0], guard)
+            elif isinstance(x, ast.Dict):
+                for k, v in zip(x.keys, x.values):
+                    if k is not None:
+                        scan(k, guard)
+                    scan(v, guard)
+            elif not isinstance(x, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp,
+                                    ast.DictComp)):
+                for y in ast.iter_child_nodes(x):
+                    scan(y, guard)
+                if not isinstance(x, pure_types):
+                    state['clean'] = False  # e.g. a call, after its arguments
+                return
+            if not pure(x):
+                state['clean'] = False
+        for x in exprs:
+            scan(x, None)
+        return rv
+
+    def emit_fused(self, fused, finish, exit):
+        # finish: statement using the result; exit: how to leave the loop early
+        steps, init, body, result = fused
+        if exit == 'break' and len([x for x in steps if x[0] == 'for']) > 1:
+            # break leaves the innermost loop only, so no early exit
+            exit = ''
+        else:
+            exit = exit % result if '%s' in exit else exit
+        for line in init:
+            self.indent()
+            self.emit(line + '\n')
+        ends = 0
+        for kind, line in steps:
+            self.indent()
+            if kind == 'if':
+                line = 'if %s then' % line
+            self.emit(line + '\n')
+            if kind != 'let':
+                ends += 1
+                self.push_scope()
+        for line in filter(None, body):
+            self.indent()
+            self.emit(line % {'exit': exit} + '\n')
+        for i in range(ends):
+            self.pop_scope()
+            self.indent()
+            self.emit('end\n')
+        self.indent()
+        self.emit(finish % result + '\n')
+
     def visit_ListComp(self, node):
         if len(node.generators)>1 or len(node.generators[0].ifs)>1:
             self.emit('PYLUA.COMPREHENSION()')
             return
         gen = node.generators[0]
-        self.emit('PYLUA.collect(')
+        self.emit_std('PYLUA.collect')
+        self.emit('(')
         self.visit(gen.iter)
         self.emit(', function(')
         if not isinstance(gen.target, ast.Name):
@@ -709,30 +1796,17 @@ class PyLua(ast.NodeVisitor):
 
     def visit_Compare(self, node):
         if len(node.ops)==1 and isinstance(node.ops[0], ast.NotIn):
-            self.visit_all_sep(node.comparators, ', ')
-            self.emit('[')
-            self.visit(node.left)
-            self.emit('] == nil')
+            self.visit_membership(node.left, node.comparators[0], True)
         elif len(node.ops)==1 and isinstance(node.ops[0], ast.In):
-            if len(node.comparators)==1 and isinstance(node.comparators[0], ast.Attribute) and \
-                    node.comparators[0].attr == 'keys':
-                # x in y.keys() --> y[x]
-                self.visit(node.comparators[0])
-                self.emit('[')
-                self.visit(node.left)
-                self.emit(']')
-                return
-            self.visit_all_sep(node.comparators, ', ')
-            self.emit('[')
-            self.visit(node.left)
-            self.emit('] ~= nil')
+            self.visit_membership(node.left, node.comparators[0], False)
         elif len(node.ops)==1 and isinstance(node.ops[0], ast.Is):
             if len(node.comparators)==1 and isinstance(node.comparators[0], ast.Name) and \
                     node.comparators[0].id == 'None':
                 self.visit(node.left)
                 self.emit(' == nil')
                 return
-            self.emit('PYLUA.op_is(')
+            self.emit_std('PYLUA.op_is')
+            self.emit('(')
             self.visit(node.left)
             self.emit(', ')
             self.visit_all_sep(node.comparators, ', ')
@@ -743,16 +1817,367 @@ class PyLua(ast.NodeVisitor):
                 self.visit(node.left)
                 self.emit(' ~= nil')
                 return
-            self.emit('PYLUA.op_is_not(')
+            self.emit_std('PYLUA.op_is_not')
+            self.emit('(')
             self.visit(node.left)
             self.emit(', ')
             self.visit_all_sep(node.comparators, ', ')
             self.emit(')')
+        elif len(node.ops)==1 and type(node.ops[0]) in self.checked_cmps and \
+                not self.is_float(node.left, node.comparators[0]) and \
+                'str' not in (self.expr_type(node.left), self.expr_type(node.comparators[0])):
+            # a promoted PYLUA.bigint on one side only: LuaJIT and Lua 5.1 do not
+            # call __lt/__le for a number and a table
+            self.emit_std(self.checked_cmps[type(node.ops[0])])
+            self.emit('(')
+            self.visit(node.left)
+            self.emit(', ')
+            self.visit(node.comparators[0])
+            self.emit(')')
         else:
             self.visit(node.left)
             self.visit_all(node.ops)
             self.visit_all(node.comparators)
 
+    # integer comparisons which may mix native numbers and bigints
+    checked_cmps = {ast.Lt: 'PYLUA.lt', ast.LtE: 'PYLUA.le', ast.Gt: 'PYLUA.gt',
+                    ast.GtE: 'PYLUA.ge'}
+
+    def visit_membership(self, item, coll, negate):
+        key = self.const_key(coll)
+        kind = self.expr_type(coll)
+        view = self.view_of(coll)
+        if view and view[0] == 'keys':
+            # x in y.keys() --> y[x]
+            self.visit(view[1])
+            self.emit('[')
+            self.visit(item)
+            self.emit(negate and '] == nil' or '] ~= nil')
+        elif view and view[0] == 'items' and isinstance(item, ast.Tuple) and len(item.elts) == 2:
+            # (k, v) in y.items() --> y[k] == v
+            self.emit(negate and 'not (' or '(')
+            self.visit(view[1])
+            self.emit('[')
+            self.visit(item.elts[0])
+            self.emit('] == ')
+            self.visit(item.elts[1])
+            self.emit(')')
+        elif view:
+            self.emit(negate and 'not ' or '')
+            self.emit_std('PYLUA.contains')
+            self.emit('(')
+            self.visit_view(coll)
+            self.emit(', ')
+            self.visit(item)
+            self.emit(')')
+        elif key in self.consttables:
+            # constant literal, hoisted by visit_Module
+            self.emit(self.consttables[key])
+            self.emit('[')
+            self.visit(item)
+            self.emit(negate and '] == nil' or '] ~= nil')
+        elif kind == 'str':
+            self.emit_std('string.find')
+            self.emit('(')
+            self.visit(coll)
+            self.emit(', ')
+            self.visit(item)
+            self.emit(negate and ', 1, true) == nil' or ', 1, true) ~= nil')
+        elif isinstance(coll, (ast.List, ast.Tuple, ast.Set)) and isinstance(item, ast.Name) and \
+                len(coll.elts) > 0:
+            # x in (a, b) --> (x == a or x == b), no table built
+            self.emit(negate and 'not (' or '(')
+            first = True
+            for x in coll.elts:
+                if first:
+                    first = False
+                else:
+                    self.emit(' or ')
+                self.visit(item)
+                self.emit(' == ')
+                self.visit(x)
+            self.emit(')')
+        elif kind == 'list':
+            # linear scan, no table built
+            self.emit(negate and 'not ' or '')
+            self.emit_std('PYLUA.contains')
+            self.emit('(')
+            self.visit(coll)
+            self.emit(', ')
+            self.visit(item)
+            self.emit(')')
+        else:
+            # dicts and sets are keyed by their members
+            self.visit(coll)
+            self.emit('[')
+            self.visit(item)
+            self.emit(negate and '] == nil' or '] ~= nil')
+
+    # dict view methods; the Python 2 iter* variants are treated as views too
+    view_methods = {'keys':'keys', 'values':'values', 'items':'items',
+                    'iterkeys':'keys', 'itervalues':'values', 'iteritems':'items',
+                    'viewkeys':'keys', 'viewvalues':'values', 'viewitems':'items'}
+
+    def view_of(self, node):
+        # ('keys'/'values'/'items', dict) for a call d.keys() etc, else None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                node.func.attr in self.view_methods and not node.args and not node.keywords:
+            return self.view_methods[node.func.attr], node.func.value
+        return None
+
+    def visit_view(self, node):
+        # the live view d.keys() etc itself, where the caller knows how to use it
+        view, d = self.view_of(node)
+        self.emit_std('PYLUA.' + view)
+        self.emit('(')
+        self.visit(d)
+        self.emit(')')
+
+    def const_key(self, node):
+        # hashable key for a list/tuple/set literal of constants, None otherwise
+        if not isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return None
+        key = []
+        for x in node.elts:
+            try:
+                value = ast.literal_eval(x)
+            except ValueError:
+                return None
+            if value is None or isinstance(value, (tuple, list, dict, set)):
+                return None
+            key.append((type(value).__name__, value))
+        return tuple(key)
+
+    def visit_Module(self, node):
+        # 'x in <constant literal>': build the lookup table once, at load time
+        for x in ast.walk(node):
+            if isinstance(x, ast.Compare) and len(x.ops)==1 and \
+                    isinstance(x.ops[0], (ast.In, ast.NotIn)):
+                key = self.const_key(x.comparators[0])
+                if key is not None and key not in self.consttables:
+                    name = 'PYLUA_in%d' % (len(self.consttables)+1)
+                    self.consttables[key] = name
+                    self.emit('local %s = ' % name)
+                    self.visit_Set(x.comparators[0])
+                    self.eol()
+        self.ordered = self.ordered_dicts(node)
+        self.globals = set(name for x in ast.walk(node) if isinstance(x, ast.Global)
+                           for name in x.names)
+        self.multireturn = self.multi_return_functions(node)
+        self.multireturn_defs = set(id(x) for x in node.body if isinstance(x, ast.FunctionDef) and
+                                    x.name in self.multireturn)
+        self.generic_visit(node)
+
+    def called_name(self, node):
+        # 'f' for a call f(...), else None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            return node.func.id
+        return None
+
+    def multi_return_functions(self, tree):
+        """
+        Module-level functions which always return an n-tuple that every caller
+        unpacks right away (a, b = f()), as {name: n}.  These return Lua
+        multiple values instead of building a table.  Callers elsewhere could
+        not know, so without whole-program information only private (_name)
+        functions qualify.
+        """
+        def returns(func):
+            rv = []
+            todo = list(func.body)
+            while todo:
+                x = todo.pop()
+                if isinstance(x, ast.Return):
+                    rv.append(x)
+                elif x.__class__.__name__ in ('Yield', 'YieldFrom', 'Await'):
+                    return None
+                elif not isinstance(x, (ast.FunctionDef, ast.Lambda, ast.ClassDef)) and \
+                        x.__class__.__name__ != 'AsyncFunctionDef':
+                    todo.extend(ast.iter_child_nodes(x))
+            return rv
+
+        functions = {}
+        for func in tree.body:
+            if not isinstance(func, ast.FunctionDef) or func.decorator_list:
+                continue
+            if self.extern is None:
+                shared = not func.name.startswith('_')
+            else:
+                shared = func.name in self.extern
+            if shared:
+                continue
+            rets = returns(func)
+            sizes = set(len(x.value.elts) for x in rets or ()
+                        if isinstance(x.value, ast.Tuple))
+            if rets and len(sizes) <= 1 and sizes != {1} and \
+                    all(isinstance(x.value, ast.Tuple) or self.called_name(x.value)
+                        for x in rets):
+                # n is None when it only returns what other functions return
+                functions[func.name] = (func, rets, sizes.pop() if sizes else None)
+        changed = True
+        while changed:
+            changed = False
+            for name, (func, rets, n) in list(functions.items()):
+                called = set(functions.get(self.called_name(x.value), (0, 0, None))[2]
+                             for x in rets if self.called_name(x.value))
+                if n is None and len(called) == 1 and None not in called:
+                    functions[name] = (func, rets, called.pop())
+                    changed = True
+        for name, (func, rets, n) in list(functions.items()):
+            if n is None:
+                del functions[name]
+        names = [x.name for x in tree.body if isinstance(x, (ast.FunctionDef, ast.ClassDef))]
+        methods = set(id(y) for x in ast.walk(tree) if isinstance(x, ast.ClassDef)
+                      for y in x.body)
+        for x in ast.walk(tree):
+            # nested functions, classes and parameters of the same name
+            if isinstance(x, (ast.FunctionDef, ast.ClassDef)) and x not in tree.body and \
+                    id(x) not in methods:
+                names.append(x.name)
+            elif isinstance(x, ast.arguments):
+                names.extend(a for a in [x.vararg, x.kwarg] if isinstance(a, str))
+                names.extend(getattr(a, 'arg', None) for a in
+                             [x.vararg, x.kwarg] + x.args + getattr(x, 'kwonlyargs', []))
+        for name in list(functions):
+            if names.count(name) > 1:
+                del functions[name]  # redefined, or shadowed
+
+        parents = {}
+        for x in ast.walk(tree):
+            for y in ast.iter_child_nodes(x):
+                parents[id(y)] = x
+        changed = True
+        while changed:
+            changed = False
+            for name, (func, rets, n) in list(functions.items()):
+                ok = True
+                calls = 0
+                for x in rets:
+                    # return g(...) passes g's values on
+                    called = self.called_name(x.value)
+                    if called and functions.get(called, (0, 0, 0))[2] != n:
+                        ok = False
+                for x in ast.walk(tree):
+                    if not (isinstance(x, ast.Name) and x.id == name):
+                        continue
+                    call = parents.get(id(x))
+                    user = call and parents.get(id(call))
+                    calls += 1
+                    if not isinstance(call, ast.Call) or call.func is not x:
+                        ok = False
+                    elif isinstance(user, ast.Assign) and user.value is call and \
+                            len(user.targets) == 1 and isinstance(user.targets[0], ast.Tuple) and \
+                            len(user.targets[0].elts) == n and \
+                            not any(y.__class__.__name__ == 'Starred' for y in user.targets[0].elts):
+                        pass
+                    elif isinstance(user, ast.Return) and any(user in v[1] for v in functions.values()
+                                                              if v[2] == n):
+                        pass
+                    else:
+                        ok = False
+                if not ok or not calls:
+                    del functions[name]
+                    changed = True
+        return dict((name, v[2]) for name, v in functions.items())
+
+    # dict methods and functions which do not depend on the order of the keys
+    unordered_methods = {'get', 'setdefault', 'pop', 'update', 'clear', 'has_key'}
+    unordered_funcs = {'len', 'sorted', 'set', 'frozenset', 'isinstance', 'bool', 'min', 'max',
+                       'any', 'all', 'sum'}
+
+    def ordered_dicts(self, tree):
+        """
+        id()s of the dict literals (and dict() calls) in *tree* whose key order
+        may be observed: assigned to a variable or attribute which is iterated,
+        or which escapes into other code.  Only these become PYLUA.odict, the
+        rest stay plain tables.
+        FIXME: leaky heuristic; variables are matched by name across the module.
+        """
+        parents = {}
+        for x in ast.walk(tree):
+            for y in ast.iter_child_nodes(x):
+                parents[id(y)] = x
+        observed = set()
+        for x in ast.walk(tree):
+            chain = self.attr_chain(x)
+            if not chain or not isinstance(x.ctx, ast.Load):
+                continue
+            parent = parents.get(id(x))
+            if isinstance(parent, ast.Attribute):
+                call = parents.get(id(parent))
+                if parent.attr in self.unordered_methods or \
+                        not (isinstance(call, ast.Call) and call.func is parent):
+                    continue
+                user = parents.get(id(call))
+                if parent.attr in self.view_methods and \
+                        (isinstance(user, ast.Compare) or isinstance(user, ast.Call) and
+                         isinstance(user.func, ast.Name) and user.func.id in self.unordered_funcs):
+                    # 'x in d.keys()', len(d.items())
+                    continue
+            elif isinstance(parent, (ast.Subscript, ast.Compare)):
+                continue
+            elif isinstance(parent, ast.Call) and isinstance(parent.func, ast.Name) and \
+                    parent.func.id in self.unordered_funcs:
+                continue
+            elif isinstance(parent, ast.Call) and parent.func is x:
+                continue
+            elif isinstance(parent, (ast.AugAssign, ast.Delete)):
+                continue
+            observed.add(chain)
+
+        rv = set()
+        for x in ast.walk(tree):
+            if isinstance(x, ast.Assign) and (isinstance(x.value, ast.Dict) or
+                                              isinstance(x.value, ast.Call) and
+                                              isinstance(x.value.func, ast.Name) and
+                                              x.value.func.id == 'dict' and
+                                              not x.value.args and not x.value.keywords):
+                if any(self.attr_chain(t) in observed for t in x.targets):
+                    rv.add(id(x.value))
+            elif isinstance(x, ast.Dict) and not isinstance(parents.get(id(x)), ast.Assign):
+                # used in place, e.g. returned or passed on
+                rv.add(id(x))
+        return rv
+
+    def visit_sequence(self, node):
+        # *node* where a Lua sequence is wanted: sets keep their elements as keys
+        if self.expr_type(node) == 'set':
+            self.emit_std('PYLUA.list')
+            self.emit('(')
+            self.emit_std('PYLUA.keys')
+            self.emit('(')
+            self.visit(node)
+            self.emit('))')
+        else:
+            self.visit(node)
+
+    # set methods which change the set, as Lua statements
+    set_methods = {'add': '%s[%s] = true', 'discard': '%s[%s] = nil', 'remove': '%s[%s] = nil'}
+
+    def visit_set_method(self, call):
+        # s.add(x) etc on a known set --> s[x] = true; False when not one
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and
+                self.expr_type(call.func.value) == 'set' and len(call.args) == 1):
+            return False
+        s, arg = self.text(call.func.value), call.args[0]
+        if call.func.attr in self.set_methods:
+            self.emit(self.set_methods[call.func.attr] % (s, self.text(arg)))
+        elif call.func.attr == 'update' and self.expr_type(arg) == 'set':
+            self.emit('for k in pairs(%s) do %s[k] = true end' % (self.text(arg), s))
+        elif call.func.attr == 'update':
+            self.emit('for _, k in ipairs(%s) do %s[k] = true end' % (self.text(arg), s))
+        else:
+            return False
+        return True
+
+    def visit_Set(self, node):
+        self.emit('{')
+        for x in node.elts:
+            self.emit('[')
+            self.visit(x)
+            self.emit(']=true, ')
+        self.emit('}')
+
     def visit_Lt(self, node):
         self.emit('<')
     def visit_LtE(self, node):
@@ -840,15 +2265,480 @@ class PyLua(ast.NodeVisitor):
     def env_pop(self):
         self.envs.pop()
     def env_add(self, name):
+        if not self.env_has(name):
+            self.envs[len(self.envs)-1][name] = True
+    def env_bind(self, name):
+        # a new binding in the innermost scope, of unknown type
         self.envs[len(self.envs)-1][name] = True
+    def env_settype(self, name, kind):
+        # kind is 'str', 'list', ... or None when unknown
+        self.envs[len(self.envs)-1][name] = kind or True
+    def env_type(self, name):
+        for env in reversed(self.envs):
+            if name in env:
+                return env[name] if env[name] is not True else None
+        return None
     def env_has(self, name):
         for env in self.envs:
             if name in env:
                 return True
         return False
 
+class WholeProgram(object):
+    """
+    Whole-program translation, starting from the script *filename*.  Modules
+    imported by it (and found next to it) are loaded too; small pure functions
+    are inlined at their call sites, then functions, classes and module-level
+    assignments which nothing reachable uses are dropped.
+    """
+    def __init__(self, filename):
+        self.path = os.path.dirname(os.path.abspath(filename))
+        # module name -> ast.Module; the entry script is '__main__'
+        self.modules = {}
+        self.load('__main__', filename)
+
+    def load(self, name, filename):
+        contents = open(filename).read()
+        if not contents.endswith('\n'):
+            contents += '\n'
+        tree = ast.parse(contents, filename)
+        self.modules[name] = tree
+        for x in ast.walk(tree):
+            if isinstance(x, ast.Import):
+                names = [a.name for a in x.names]
+            elif isinstance(x, ast.ImportFrom) and x.module and not x.level:
+                # 'from pkg import mod' may name a submodule
+                names = [x.module] + [x.module + '.' + a.name for a in x.names]
+            else:
+                continue
+            for module in names:
+                if module in self.modules:
+                    continue
+                base = os.path.join(self.path, *module.split('.'))
+                for f in (base + '.py', os.path.join(base, '__init__.py')):
+                    if os.path.exists(f):
+                        self.load(module, f)
+                        break
+
+    def imports(self, name):
+        # local name -> ('module', module) or ('name', module, name), for loaded modules
+        rv = {}
+        for x in self.modules[name].body:
+            if isinstance(x, ast.Import):
+                for a in x.names:
+                    if a.name in self.modules:
+                        rv[a.asname or a.name] = ('module', a.name)
+            elif isinstance(x, ast.ImportFrom) and x.module and not x.level:
+                for a in x.names:
+                    if x.module + '.' + a.name in self.modules:
+                        rv[a.asname or a.name] = ('module', x.module + '.' + a.name)
+                    elif x.module in self.modules:
+                        rv[a.asname or a.name] = ('name', x.module, a.name)
+        return rv
+
+    def defs(self, name):
+        # top-level statements which can be dropped: name -> [statements]
+        rv = {}
+        for x in self.modules[name].body:
+            if isinstance(x, (ast.FunctionDef, ast.ClassDef)):
+                rv.setdefault(x.name, []).append(x)
+            elif isinstance(x, ast.Assign) and \
+                    all(isinstance(t, ast.Name) for t in x.targets) and \
+                    not any(isinstance(y, ast.Call) for y in ast.walk(x.value)):
+                for t in x.targets:
+                    rv.setdefault(t.id, []).append(x)
+        return rv
+
+    def resolve(self, module, node):
+        # (module, name) of the top-level definition *node* refers to, if known
+        imports = self.imports(module)
+        if isinstance(node, ast.Name):
+            if node.id in imports and imports[node.id][0] == 'name':
+                return imports[node.id][1:]
+            return module, node.id
+        if isinstance(node, ast.Attribute):
+            # m.f, or pkg.mod.f after 'import pkg.mod'
+            chain = []
+            x = node.value
+            while isinstance(x, ast.Attribute):
+                chain.insert(0, x.attr)
+                x = x.value
+            if isinstance(x, ast.Name):
+                target = imports.get('.'.join([x.id] + chain), (None,))
+                if target[0] == 'module':
+                    return target[1], node.attr
+        return None
+
+    def inlinable(self, node):
+        # the expression of a 'def f(a, b): return <expr>' without calls, else None
+        if not isinstance(node, ast.FunctionDef) or node.decorator_list:
+            return None
+        args = node.args
+        if args.vararg or args.kwarg or args.defaults or getattr(args, 'kwonlyargs', None):
+            return None
+        body = node.body
+        if len(body) == 2 and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Str):
+            body = body[1:]  # docstring
+        if len(body) != 1 or not isinstance(body[0], ast.Return) or body[0].value is None:
+            return None
+        params = set(self.param_names(node))
+        for x in ast.walk(body[0].value):
+            if not isinstance(x, (ast.expr_context, ast.operator, ast.unaryop, ast.boolop,
+                                  ast.cmpop, ast.BinOp, ast.UnaryOp, ast.BoolOp,
+                                  ast.Compare, ast.IfExp, ast.Name, ast.Num, ast.Str,
+                                  ast.Tuple, ast.Subscript, ast.Attribute, ast.Slice,
+                                  getattr(ast, 'Index', ast.Slice),
+                                  getattr(ast, 'Constant', ast.Num),
+                                  getattr(ast, 'NameConstant', ast.Num))):
+                return None
+            # only arguments; globals would not resolve in the caller's module
+            if isinstance(x, ast.Name) and x.id not in params and \
+                    x.id not in ('None', 'True', 'False'):
+                return None
+        return body[0].value
+
+    def param_names(self, node):
+        return [getattr(a, 'arg', None) or getattr(a, 'id', None) for a in node.args.args]
+
+    def local_names(self, node):
+        # names the function (or lambda) *node* binds in its own scope
+        rv = set()
+        for a in [node.args.vararg, node.args.kwarg] + node.args.args + \
+                getattr(node.args, 'kwonlyargs', []):
+            if a is not None:
+                rv.update(n.id for n in ast.walk(a) if isinstance(n, ast.Name))
+                if isinstance(a, str):
+                    rv.add(a)  # Python 2 *args/**kwargs
+                elif getattr(a, 'arg', None):
+                    rv.add(a.arg)
+        body = node.body if isinstance(node.body, list) else [node.body]
+        declared = set()
+        todo = list(body)
+        while todo:
+            x = todo.pop()
+            if isinstance(x, ast.Name) and isinstance(x.ctx, (ast.Store, ast.Del)):
+                rv.add(x.id)
+            elif isinstance(x, (ast.FunctionDef, ast.ClassDef,
+                                getattr(ast, 'AsyncFunctionDef', ast.FunctionDef))):
+                rv.add(x.name)
+                continue  # a scope of its own
+            elif isinstance(x, ast.Lambda):
+                continue
+            elif isinstance(x, (ast.Import, ast.ImportFrom)):
+                rv.update((a.asname or a.name).split('.')[0] for a in x.names)
+            elif isinstance(x, (ast.Global, getattr(ast, 'Nonlocal', ast.Global))):
+                declared.update(x.names)
+            elif isinstance(x, ast.ExceptHandler) and isinstance(x.name, str):
+                rv.add(x.name)
+            todo.extend(ast.iter_child_nodes(x))
+        return rv - declared
+
+    def inline(self):
+        functions = {}
+        for module in self.modules:
+            for name, nodes in self.defs(module).items():
+                if len(nodes) == 1 and self.inlinable(nodes[0]) is not None:
+                    functions[(module, name)] = nodes[0]
+
+        program = self
+        class Inliner(ast.NodeTransformer):
+            # names bound locally by the enclosing functions
+            bound = []
+
+            def visit_FunctionDef(self, node):
+                self.bound.append(program.local_names(node))
+                self.generic_visit(node)
+                self.bound.pop()
+                return node
+            visit_AsyncFunctionDef = visit_Lambda = visit_FunctionDef
+
+            def visit_Call(self, node):
+                self.generic_visit(node)
+                base = node.func
+                while isinstance(base, ast.Attribute):
+                    base = base.value
+                if isinstance(base, ast.Name) and any(base.id in b for b in self.bound):
+                    # a parameter or local variable, not the global function
+                    return node
+                target = program.resolve(self.module, node.func)
+                if target not in functions or node.keywords or \
+                        getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                    return node
+                func = functions[target]
+                params = program.param_names(func)
+                if len(params) != len(node.args):
+                    return node
+                for arg in node.args:
+                    # arguments may end up evaluated never, or more than once
+                    for x in ast.walk(arg):
+                        if isinstance(x, (ast.Call, ast.Lambda, ast.ListComp, ast.DictComp,
+                                          ast.SetComp, ast.GeneratorExp)) or \
+                                x.__class__.__name__ in ('Starred', 'Yield', 'Await'):
+                            return node
+                args = dict(zip(params, node.args))
+                class Substitute(ast.NodeTransformer):
+                    def visit_Name(self, x):
+                        return copy.deepcopy(args[x.id]) if x.id in args else x
+                return Substitute().visit(copy.deepcopy(program.inlinable(func)))
+
+        for module, tree in self.modules.items():
+            inliner = Inliner()
+            inliner.module = module
+            inliner.visit(tree)
+
+    def eliminate(self):
+        reached = set()
+        todo = []
+        everything = set()
+        for module in self.modules:
+            defs = self.defs(module)
+            dynamic = False
+            for x in ast.walk(self.modules[module]):
+                if isinstance(x, ast.Name) and x.id in ('globals', 'eval', 'exec', 'getattr'):
+                    dynamic = True
+                if isinstance(x, ast.ImportFrom) and any(a.name == '*' for a in x.names):
+                    everything.add(x.module)
+            if dynamic:
+                everything.add(module)
+            droppable = set(id(x) for nodes in defs.values() for x in nodes)
+            for x in self.modules[module].body:
+                if id(x) not in droppable:
+                    todo.append((module, x))
+
+        def reach(module, name):
+            if (module, name) in reached or module not in self.modules:
+                return
+            reached.add((module, name))
+            for x in self.defs(module).get(name, []):
+                todo.append((module, x))
+
+        for module in everything:
+            for name in self.defs(module) if module in self.modules else ():
+                reach(module, name)
+        while todo:
+            module, node = todo.pop()
+            imports = self.imports(module)
+            for x in ast.walk(node):
+                if isinstance(x, ast.Name):
+                    target = self.resolve(module, x)
+                    reach(*target)
+                    if imports.get(x.id, (None,))[0] == 'module' and \
+                            not any(isinstance(y, ast.Attribute) and y.value is x
+                                    for y in ast.walk(node)):
+                        # the module object itself escapes, keep all of it
+                        for name in self.defs(imports[x.id][1]):
+                            reach(imports[x.id][1], name)
+                elif isinstance(x, ast.Attribute):
+                    target = self.resolve(module, x)
+                    if target:
+                        reach(*target)
+
+        for module, tree in self.modules.items():
+            defs = self.defs(module)
+            keep = []
+            for x in tree.body:
+                names = [n for n, nodes in defs.items() if x in nodes]
+                if not names or any((module, n) in reached for n in names):
+                    keep.append(x)
+            tree.body = keep
+
+    def translate(self, **kwargs):
+        # module name -> Lua program
+        self.inline()
+        self.eliminate()
+        program = self
+        class Submodules(ast.NodeTransformer):
+            # from pkg import mod --> import pkg.mod as mod, when mod is a module
+            def visit_ImportFrom(self, node):
+                if not node.module or node.level:
+                    return node
+                rv = []
+                for a in node.names:
+                    name = node.module + '.' + a.name
+                    if name in program.modules:
+                        rv.append(ast.Import(names=[ast.alias(name, a.asname or a.name)]))
+                    elif rv and isinstance(rv[-1], ast.ImportFrom):
+                        rv[-1].names.append(a)
+                    else:
+                        rv.append(ast.ImportFrom(node.module, [a], 0))
+                return [ast.copy_location(x, node) for x in rv]
+        extern = dict((module, set()) for module in self.modules)
+        for module, tree in self.modules.items():
+            for x in ast.walk(tree):
+                target = isinstance(x, (ast.Name, ast.Attribute)) and self.resolve(module, x)
+                if target and target[0] != module and target[0] in extern:
+                    extern[target[0]].add(target[1])
+        rv = {}
+        for module, tree in self.modules.items():
+            Submodules().visit(tree)
+            visitor = PyLua(extern=extern[module], **kwargs)
+            visitor.visit(tree)
+            rv[module] = visitor.stream.getvalue()
+        return rv
+
+
+# the Lua state shared by all @jit functions, created on first use
+_jit_lua = None
+
+def _jit_state():
+    global _jit_lua
+    if _jit_lua is None:
+        import lupa
+        _jit_lua = lupa.LuaRuntime(unpack_returned_tuples=True)
+        _jit_lua.execute('PYLUA_loaded = pcall(require, %r)' % lua_runtime)
+    return _jit_lua
+
+# operators which PyLua has a translation for
+_jit_ops = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.FloorDiv,
+            ast.Not, ast.USub, ast.And, ast.Or,
+            ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In, ast.NotIn,
+            ast.Is, ast.IsNot)
+
+def _jit_unsupported(tree):
+    # why *tree* cannot be translated faithfully, or None
+    func = tree.body[0]
+    params = set(getattr(a, 'arg', None) or getattr(a, 'id', None) for a in func.args.args)
+    for x in ast.walk(tree):
+        name = x.__class__.__name__
+        if isinstance(x, (ast.Assign, ast.AugAssign, ast.Delete)) or name == 'AnnAssign':
+            # arguments are copies in Lua: changes would not reach the caller
+            for target in getattr(x, 'targets', None) or [x.target]:
+                base = target
+                while isinstance(base, (ast.Subscript, ast.Attribute)):
+                    base = base.value
+                if base is not target and isinstance(base, ast.Name) and base.id in params:
+                    return 'stores into argument ' + base.id
+        elif isinstance(x, ast.Call) and isinstance(x.func, ast.Attribute) and \
+                isinstance(x.func.value, ast.Name) and x.func.value.id in params and \
+                x.func.attr in ('append', 'extend', 'insert', 'pop', 'remove', 'sort',
+                                'reverse', 'clear', 'update', 'setdefault', 'popitem'):
+            return 'modifies argument ' + x.func.value.id
+        if isinstance(x, ast.Subscript) and not isinstance(x.slice, ast.Slice):
+            index = x.slice.value if isinstance(x.slice, getattr(ast, 'Index', ())) else x.slice
+            if not isinstance(index, (ast.Num, ast.Str)) and \
+                    not (isinstance(index, getattr(ast, 'Constant', ())) and
+                         isinstance(index.value, (int, str))):
+                # only constant list indices are shifted to 1-based ones
+                return 'subscript ' + index.__class__.__name__
+        if isinstance(x, (ast.operator, ast.unaryop, ast.boolop, ast.cmpop)):
+            if not isinstance(x, _jit_ops):
+                return 'operator ' + name
+        elif isinstance(x, ast.arguments):
+            if x.vararg or x.kwarg or getattr(x, 'kwonlyargs', None):
+                return '*args/**kwargs'
+        elif isinstance(x, getattr(ast, 'Constant', ())):
+            if not isinstance(x.value, (int, float, str, bool, type(None))):
+                return 'constant ' + repr(x.value)
+        elif not (hasattr(PyLua, 'visit_' + name) or
+                  isinstance(x, (ast.expr_context, ast.comprehension, ast.keyword,
+                                 ast.Module, getattr(ast, 'Index', ast.Slice)))):
+            return name
+    return None
+
+def _jit_arg(lua, value):
+    # numbers and strings go as they are; lists, tuples and dicts become tables,
+    # with their contents converted the same way
+    if isinstance(value, (list, tuple)):
+        return lua.table_from([_jit_arg(lua, x) for x in value])
+    if isinstance(value, dict):
+        return lua.table_from(dict((_jit_arg(lua, k), _jit_arg(lua, v))
+                                   for k, v in value.items()))
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    return value
+
+def _jit_result(value):
+    # tables come back as lists when they are sequences, as dicts otherwise
+    import lupa
+    if lupa.lua_type(value) != 'table':
+        return value
+    items = dict(value.items())
+    if list(items.keys()) == list(range(1, len(items)+1)):
+        return [_jit_result(items[i]) for i in range(1, len(items)+1)]
+    return dict((k, _jit_result(v)) for k, v in items.items())
+
+def jit(func):
+    """
+    Decorator: run the pure-Python function *func* as Lua, in an in-process
+    Lua state (via lupa).  The function is translated and loaded once, on its
+    first call; numbers and strings are passed as they are, lists, tuples and
+    dicts (also nested ones) as Lua tables.  Whenever that is not possible (no
+    lupa, constructs PyLua cannot translate faithfully, errors in Lua) *func*
+    itself is run instead, and the reason is logged.  As the tables are
+    copies, functions which modify their arguments always run in Python.
+    """
+    state = {}
+
+    def fallback(reason):
+        log.warning('pylua.jit: running %s in Python: %s', func.__name__, reason)
+        state['lua'] = None
+
+    def load():
+        if func.__code__.co_freevars:
+            return fallback('closures are not supported')
+        try:
+            tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+        except (IOError, OSError, TypeError, SyntaxError) as e:
+            return fallback('no source: %s' % e)
+        node = tree.body[0]
+        if not isinstance(node, ast.FunctionDef):
+            # e.g. a lambda: the source is the statement around it
+            return fallback('only def functions are supported')
+        node.decorator_list = []
+        reason = _jit_unsupported(tree)
+        if reason:
+            return fallback('unsupported: %s' % reason)
+        try:
+            lua = _jit_state()
+        except ImportError:
+            return fallback('lupa is not installed')
+        # math.pow, unpack etc depend on the Lua lupa was built with
+        visitor = PyLua(lua_version=getattr(lua, 'lua_version', (5, 1)))
+        try:
+            visitor.visit(tree)
+        except Exception as e:
+            return fallback('translation failed: %r' % e)
+        program = visitor.stream.getvalue()
+        if 'FIXME' in program or '[ ? ]' in program:
+            return fallback('translation is incomplete')
+        if 'PYLUA.' in program and not lua.globals().PYLUA_loaded:
+            return fallback('the %s Lua runtime is not available' % lua_runtime)
+        try:
+            lua.execute(program)
+        except Exception as e:
+            return fallback('Lua error: %s' % e)
+        state['lua'] = lua
+        state['func'] = lua.globals()[node.name]
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if 'lua' not in state:
+            load()
+        lua = state['lua']
+        if lua is None or kwargs:
+            return func(*args, **kwargs)
+        try:
+            rv = state['func'](*[_jit_arg(lua, x) for x in args])
+        except Exception as e:
+            fallback('Lua error: %s' % e)
+            return func(*args)
+        return _jit_result(rv)
+
+    return wrapper
+
 _dump_ast=dump
-def run_file(filename, dump=False):
+def run_file(filename, dump=False, whole_program=False):
+    if whole_program:
+        programs = WholeProgram(filename).translate()
+        for module, program in programs.items():
+            if module != '__main__':
+                # where require('pkg.mod') looks: pkg/mod.lua
+                filename = os.path.join(*module.split('.')) + '.lua'
+                if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                open(filename, 'w').write(program)
+        return runjit(programs['__main__'])
+
     contents = open(filename, 'rU').read()
     if not contents.endswith('\n'):
         contents += '\n'
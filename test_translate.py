@@ -0,0 +1,102 @@
+"""
+Checks on the Lua code PyLua emits, for what the end-to-end tests in tests/
+cannot run: other Lua versions than LuaJIT's, Python 3 only syntax.
+Run with Python 3: python -m unittest test_translate
+"""
+import ast
+import unittest
+
+import pylua
+
+def translate(source, **kwargs):
+    visitor = pylua.PyLua(**kwargs)
+    visitor.visit(ast.parse(source))
+    return visitor.stream.getvalue()
+
+class SliceTest(unittest.TestCase):
+    def test_table_move(self):
+        lua = translate('xs = [1, 2, 3]\n'
+                        'a = xs[-1:]\n'
+                        'b = xs[-5:]\n'
+                        'c = xs[1:-1]\n', lua_version=(5, 3))
+        self.assertIn('a = table.move(xs, math.max(1, #xs+0), #xs, 1, {})', lua)
+        # clamped like Python: no nils in front
+        self.assertIn('b = table.move(xs, math.max(1, #xs-4), #xs, 1, {})', lua)
+        self.assertIn('c = table.move(xs, 2, #xs-1, 1, {})', lua)
+
+    def test_lua51(self):
+        lua = translate('xs = [1, 2, 3]\na = xs[-1:]\n')
+        self.assertIn('a = PYLUA.slice(xs, -1, nil)', lua)
+
+class LuaVersionTest(unittest.TestCase):
+    def test_lua54(self):
+        lua = translate('def f(p):\n'
+                        '    a, b = p\n'
+                        '    return a ** 0.5\n', lua_version=(5, 4))
+        # unpack moved into table and math.pow is gone since 5.3
+        self.assertIn('table.unpack(p)', lua)
+        self.assertNotIn('math.pow', lua)
+
+class AsyncTest(unittest.TestCase):
+    def test_coroutines(self):
+        lua = translate('import asyncio\n'
+                        'async def f(x):\n'
+                        '    await asyncio.sleep(0)\n'
+                        '    y = await g(x)\n'
+                        '    return y\n')
+        self.assertIn('local asyncio = PYLUA.asyncio', lua)
+        self.assertIn('f = PYLUA.async(function(x)', lua)
+        self.assertIn('PYLUA.await(asyncio.sleep(0))', lua)
+        self.assertIn('local y = PYLUA.await(g(x))', lua)
+
+    def test_async_for(self):
+        lua = translate('async def f(xs):\n'
+                        '    async for x in xs:\n'
+                        '        print(x)\n')
+        self.assertIn('for _, x in PYLUA.aiter(xs) do', lua)
+
+class HoistTest(unittest.TestCase):
+    def test_block(self):
+        lua = translate('for x in xs:\n'
+                        '    print(x * 2)\n'
+                        'print(sum(x * 2 for x in xs))\n')
+        # module level: the hoisted locals must not pile up there
+        self.assertTrue(lua.startswith('do\n  local PYLUA_mul = PYLUA.mul\n'), lua)
+        self.assertNotIn('\nlocal ', lua)
+
+    def test_assign(self):
+        lua = translate('def f(xs):\n'
+                        '    a, b = max(x for x in xs), 1\n'
+                        '    return a\n')
+        self.assertIn('  local a, b\n  do\n', lua)
+        self.assertIn('    a, b = PYLUA_max', lua)
+
+    def test_names(self):
+        lua = translate('def f(self, xs):\n'
+                        '    for x in xs:\n'
+                        '        print(self.a_b + self.a.b)\n')
+        self.assertIn('local PYLUA_self_a_b1 = self.a_b', lua)
+        self.assertIn('local PYLUA_self_a_b2 = self and self.a and self.a.b', lua)
+
+class SortTest(unittest.TestCase):
+    def test_key_and_cmp(self):
+        lua = translate('xs.sort(key=f)\n'
+                        'xs.sort(cmpfn)\n'
+                        'ys = sorted(xs, cmpfn)\n'
+                        'ys = sorted(xs, key=f, reverse=True)\n')
+        self.assertIn('PYLUA.sort(xs, f)', lua)
+        # Python 2 cmp functions must not be taken for key functions
+        self.assertIn('PYLUA.sort(xs, PYLUA.keywords{cmp=cmpfn})', lua)
+        self.assertIn('ys = PYLUA.sorted(xs, PYLUA.keywords{cmp=cmpfn})', lua)
+        self.assertIn('ys = PYLUA.sorted(xs, f, true)', lua)
+
+class OrderedDictTest(unittest.TestCase):
+    def test_none_values(self):
+        lua = translate("d = {'a': None, 'b': 1}\n"
+                        "for k in d:\n"
+                        "    print(k)\n")
+        # the count, as # may stop at the nil
+        self.assertIn("d = PYLUA.odict(2, {'a', nil, 'b', 1})", lua)
+
+if __name__ == '__main__':
+    unittest.main()
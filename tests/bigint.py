@@ -0,0 +1,8 @@
+def fact(n):
+    return 1 if n == 0 else n * fact(n-1)
+
+print fact(25)
+print 7 // -2
+print -7 % 2
+if fact(25) > 100000000000000000000:
+    print 'big'
@@ -0,0 +1,12 @@
+import asyncio
+
+async def double(x):
+    await asyncio.sleep(0)
+    return x * 2
+
+async def main():
+    a = await double(2)
+    b = await double(a)
+    print(a + b)
+
+asyncio.run(main())
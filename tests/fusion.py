@@ -0,0 +1,4 @@
+xs = [3, 1, 4, 1, 5]
+print sum(x * 2 for x in xs if x > 1)
+print max(x for x in xs)
+print ','.join(str(x) for x in xs)
@@ -0,0 +1,20 @@
+step = 1
+
+def bump():
+    global step
+    step = step + 1
+
+total = 0
+for i in range(4):
+    total = total + step * 10
+    bump()
+print total
+
+def scaled(xs, factor):
+    rv = 0
+    for x in xs:
+        rv = rv + x * (factor + 1)
+        bump()
+    return rv
+
+print scaled([1, 2], 2)
@@ -0,0 +1,6 @@
+xs = [3, 1, 4, 1, 5]
+scale = 2
+best = 0
+for x in xs:
+    best = max(best, x * scale + scale * 3)
+print best
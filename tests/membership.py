@@ -0,0 +1,21 @@
+def kind(w):
+    if w in ('if', 'else', 'while'):
+        return 'keyword'
+    if w not in ['a', 'the']:
+        return 'word'
+    return 'stop'
+
+print kind('if')
+print kind('the')
+print kind('cat')
+
+def unique(words):
+    seen = set()
+    for w in words:
+        seen.add(w)
+    seen.discard('the')
+    if 'a' in seen:
+        return len(seen)
+    return 0
+
+print unique(['a', 'the', 'cat', 'a'])
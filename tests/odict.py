@@ -0,0 +1,8 @@
+names = {1: 'one', 2: 'two', 3: 'three'}
+names[4] = 'four'
+
+for k in names:
+    print k
+for k, v in names.items():
+    print v
+print ' '.join(names.values())
@@ -0,0 +1,4 @@
+s = 'hello world'
+print s[0:5]
+print s[-5:]
+print s[:-6]
@@ -0,0 +1,7 @@
+words = ['pear', 'fig', 'banana', 'kiwi']
+
+print ' '.join(sorted(words))
+print ' '.join(sorted(words, key=lambda w: len(w)))
+print ' '.join(sorted(words, reverse=True))
+words.sort(key=lambda w: len(w), reverse=True)
+print ' '.join(words)
@@ -0,0 +1,9 @@
+def _divmod2(a, b):
+    return a // b, a % b
+
+a, b = 1, 2
+a, b = b, a
+print a
+q, r = _divmod2(17, 5)
+print q
+print r
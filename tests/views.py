@@ -0,0 +1,15 @@
+def check(found):
+    if found:
+        return 'yes'
+    return 'no'
+
+ages = {'ann': 31, 'bob': 27}
+
+print check('ann' in ages.keys())
+print check('cid' in ages.keys())
+print check(27 in ages.values())
+print check(('bob', 27) in ages.items())
+print len(ages.keys())
+ks = ages.keys()
+ages['cid'] = 40
+print len(ks)